@@ -1,6 +1,9 @@
+import os
+import inspect
 import librosa
 import librosa.filters
 import numpy as np
+import torch
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
@@ -9,6 +12,37 @@ from hparams import hparams as hp
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
+def mel_cache_path(wavpath):
+    return os.path.splitext(wavpath)[0] + '.mel.npy'
+
+def save_mel(wavpath):
+    """Computes the mel spectrogram of wavpath and caches it next to the wav as a (T, num_mels) float32 .npy"""
+    mel = melspectrogram(load_wav(wavpath, hp.sample_rate)).T.astype(np.float32)
+
+    cache_path = mel_cache_path(wavpath)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, mel)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass # e.g. a read-only dataset, the mel is just not cached
+    return mel
+
+def load_mel(wavpath):
+    """(T, num_mels) mel spectrogram of wavpath, memory-mapped from its cache.
+
+    The cache is (re)built on a miss or when it is older than the wav. The map is
+    copy-on-write, so torch can wrap slices of it like any writable array.
+    """
+    cache_path = mel_cache_path(wavpath)
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(wavpath):
+            return np.load(cache_path, mmap_mode='c')
+    except (OSError, ValueError):
+        pass
+    return save_mel(wavpath)
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -137,3 +171,138 @@ def _denormalize(D):
         return (((D + hp.max_abs_value) * -hp.min_level_db / (2 * hp.max_abs_value)) + hp.min_level_db)
     else:
         return ((D * -hp.min_level_db / hp.max_abs_value) + hp.min_level_db)
+
+##########################################################
+# Torch implementation of melspectrogram(), batched and streaming
+
+def _stft_pad_mode():
+    # librosa.stft pads with reflection up to 0.9 and with zeros from 0.10 on; match the installed one
+    return inspect.signature(librosa.stft).parameters['pad_mode'].default
+
+_torch_mel_basis = {}
+_torch_windows = {}
+
+def _torch_constants(device):
+    device = torch.device(device)
+    if device not in _torch_mel_basis:
+        global _mel_basis
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        _torch_mel_basis[device] = torch.as_tensor(_mel_basis, dtype=torch.float32, device=device)
+        _torch_windows[device] = torch.hann_window(hp.win_size, periodic=True, device=device)
+    return _torch_mel_basis[device], _torch_windows[device]
+
+def _torch_preemphasis(wavs, prev=None):
+    # lfilter([1, -k], [1], x) along the last dim, continuing from sample `prev` (B, 1) if given
+    if not hp.preemphasize:
+        return wavs
+    if prev is None:
+        prev = torch.zeros_like(wavs[..., :1])
+    return wavs - hp.preemphasis * torch.cat((prev, wavs[..., :-1]), dim=-1)
+
+def _torch_mel_frames(padded, device):
+    # mel of already padded, pre-emphasized samples (B, T), uncentered frames
+    mel_basis, window = _torch_constants(device)
+    D = torch.stft(padded, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size,
+                   window=window, center=False, return_complex=True)
+    S = _torch_amp_to_db(torch.matmul(mel_basis, D.abs())) - hp.ref_level_db
+
+    if hp.signal_normalization:
+        return _torch_normalize(S)
+    return S
+
+def _torch_amp_to_db(x):
+    min_level = np.exp(hp.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+def _torch_normalize(S):
+    if hp.symmetric_mels:
+        S = (2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value
+        low = -hp.max_abs_value
+    else:
+        S = hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))
+        low = 0
+    if hp.allow_clipping_in_normalization:
+        return torch.clamp(S, low, hp.max_abs_value)
+    return S
+
+def melspectrogram_torch(wavs, device='cpu'):
+    """melspectrogram() in float32 torch, on `device`.
+
+    wavs: waveform (T,) or batch of equally long waveforms (B, T), numpy or tensor.
+    Returns a (num_mels, frames) or (B, num_mels, frames) float32 tensor on `device`.
+    """
+    if hp.use_lws:
+        raise NotImplementedError('The torch melspectrogram does not support use_lws')
+
+    wavs = torch.as_tensor(wavs, dtype=torch.float32, device=device)
+    single = wavs.dim() == 1
+    if single:
+        wavs = wavs[None]
+
+    # centered frames, as librosa.stft(center=True)
+    pad = hp.n_fft // 2
+    mode = _stft_pad_mode()
+    padded = torch.nn.functional.pad(_torch_preemphasis(wavs)[:, None], (pad, pad), mode=mode)[:, 0]
+    S = _torch_mel_frames(padded, device)
+
+    return S[0] if single else S
+
+class MelStream(object):
+    """Computes melspectrogram() of a waveform that arrives in chunks.
+
+    push() returns the mel frames (num_mels, n) that the samples so far fully determine,
+    close() the remaining ones once the waveform has ended. Together they equal
+    melspectrogram_torch() of the whole waveform: pre-emphasis continues across chunks
+    and every frame sees its full n_fft samples of context, including the edge padding.
+    """
+
+    def __init__(self, device='cpu'):
+        if hp.use_lws:
+            raise NotImplementedError('The torch melspectrogram does not support use_lws')
+        self.device = device
+        self.pad = hp.n_fft // 2
+        self.hop = get_hop_size()
+        self.head = torch.zeros(1, 0, device=device)   # pre-emphasized samples until the left padding is known
+        self.prev = None                                # last input sample, for the pre-emphasis
+        self.buffer = None                              # padded, pre-emphasized samples of the next frames
+        self.num_samples = 0
+
+    def _emit(self):
+        frames = (self.buffer.shape[1] - hp.n_fft) // self.hop + 1
+        if frames <= 0:
+            return torch.zeros(hp.num_mels, 0, device=self.device)
+        S = _torch_mel_frames(self.buffer[:, :(frames - 1) * self.hop + hp.n_fft], self.device)[0]
+        self.buffer = self.buffer[:, frames * self.hop:]
+        return S
+
+    def push(self, wav):
+        wav = torch.as_tensor(wav, dtype=torch.float32, device=self.device).reshape(1, -1)
+        self.num_samples += wav.shape[1]
+        y = _torch_preemphasis(wav, self.prev)
+        if wav.shape[1] > 0:
+            self.prev = wav[:, -1:]
+
+        if self.buffer is None:
+            # the left edge padding needs the first pad + 1 samples
+            self.head = torch.cat((self.head, y), dim=1)
+            if self.head.shape[1] <= self.pad:
+                return torch.zeros(hp.num_mels, 0, device=self.device)
+            left = torch.nn.functional.pad(self.head[:, None, :self.pad + 1], (self.pad, 0),
+                                           mode=_stft_pad_mode())[:, 0, :self.pad]
+            self.buffer, self.head = torch.cat((left, self.head), dim=1), None
+        else:
+            self.buffer = torch.cat((self.buffer, y), dim=1)
+
+        return self._emit()
+
+    def close(self):
+        if self.buffer is None:
+            if self.head.shape[1] == 0:
+                return torch.zeros(hp.num_mels, 0, device=self.device)
+            raise ValueError('MelStream needs more than {} samples'.format(self.pad))
+
+        tail = self.buffer[:, -(self.pad + 1):]
+        right = torch.nn.functional.pad(tail[:, None], (0, self.pad), mode=_stft_pad_mode())[:, 0, -self.pad:]
+        self.buffer = torch.cat((self.buffer, right), dim=1)
+        return self._emit()
@@ -0,0 +1,98 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import cv2
+import torch
+
+class MelWindows(object):
+	"""The (80, mel_step_size) mel window of every video frame, gathered on demand.
+
+	Indexing with an int, slice or index array returns the windows of those frames,
+	so batches are gathered in one op and the windows are never materialized up front.
+	"""
+
+	def __init__(self, mel, starts, mel_step_size=16):
+		self.windows = sliding_window_view(mel, mel_step_size, axis=1) # (80, T - mel_step_size + 1, mel_step_size) view
+		self.starts = starts
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, idx):
+		return np.moveaxis(self.windows[:, self.starts[idx]], 0, -2)
+
+def mel_windows(mel, fps, mel_step_size=16, pad_last=True):
+	"""Frame i gets the window starting at mel column int(i * 80 / fps), for every window inside the mel.
+
+	With pad_last, one more window aligned with the end of the mel covers the last partial one (inference.py).
+	"""
+	if mel.shape[1] < mel_step_size:
+		raise ValueError('Audio is too short, it needs at least {} mel frames'.format(mel_step_size))
+
+	mel_idx_multiplier = 80./fps
+	starts = (np.arange(int((mel.shape[1] - mel_step_size + 1) / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(int)
+	starts = starts[starts + mel_step_size <= mel.shape[1]]
+	if pad_last:
+		starts = np.append(starts, mel.shape[1] - mel_step_size)
+
+	return MelWindows(mel, starts, mel_step_size)
+
+class BatchBuilder(object):
+	"""Assembles Wav2Lip input batches in a ring of preallocated buffers.
+
+	Face crops are resized straight into a uint8 slot and mel windows gathered into a
+	float32 slot, so building a batch allocates nothing. A yielded batch is a view
+	into the ring and is overwritten `num_buffers` batches later; callers that keep
+	batches around (e.g. in a prefetch queue) need a ring at least that deep.
+
+	The masking, channel concat and scaling to [0, 1] the model expects are left to
+	face_input(), which does them in one op wherever the faces were uploaded.
+	"""
+
+	def __init__(self, batch_size, img_size=96, num_buffers=2, mel_shape=(80, 16)):
+		self.img_size = img_size
+		self.faces = np.empty((num_buffers, batch_size, img_size, img_size, 3), dtype=np.uint8)
+		self.mels = np.empty((num_buffers, batch_size) + tuple(mel_shape) + (1,), dtype=np.float32)
+
+		# face_input divides by this: the lower half of the masked face by inf (-> 0), the rest by 255
+		self._divisor = torch.full((1, img_size, 1, 6), 255.)
+		self._divisor[:, img_size//2:, :, :3] = float('inf')
+		self._divisors = {}
+
+	def batches(self, items, mels=None):
+		"""items: (face crop, mel index, frame, coords) tuples; mels: MelWindows (or an (N, 80, 16) array).
+
+		Without mels, the second element of each item is its (80, 16) mel window itself,
+		e.g. when the items of one batch come from several clips.
+
+		Yields (faces (B, H, W, 3) uint8, mels (B, 80, 16, 1) float32, frames, coords) batches.
+		"""
+		num_buffers, batch_size = self.faces.shape[:2]
+		buffer, n = 0, 0
+		mel_idx, frames, coords = [], [], []
+		for face, m, frame, c in items:
+			cv2.resize(face, (self.img_size, self.img_size), dst=self.faces[buffer, n])
+			if mels is None:
+				self.mels[buffer, n, ..., 0] = m
+			else:
+				mel_idx.append(m)
+			frames.append(frame)
+			coords.append(c)
+			n += 1
+
+			if n == batch_size:
+				if mels is not None:
+					self.mels[buffer, ..., 0] = mels[np.array(mel_idx)]
+				yield self.faces[buffer], self.mels[buffer], frames, coords
+				buffer, n = (buffer + 1) % num_buffers, 0
+				mel_idx, frames, coords = [], [], []
+
+		if n > 0:
+			if mels is not None:
+				self.mels[buffer, :n, ..., 0] = mels[np.array(mel_idx)]
+			yield self.faces[buffer, :n], self.mels[buffer, :n], frames, coords
+
+	def face_input(self, faces):
+		"""uint8 faces (B, H, W, 3) tensor -> masked and reference faces (B, 6, H, W) in [0, 1], on their device."""
+		if faces.device not in self._divisors:
+			self._divisors[faces.device] = self._divisor.to(faces.device)
+		return (torch.cat((faces, faces), dim=3) / self._divisors[faces.device]).permute(0, 3, 1, 2)
@@ -0,0 +1,73 @@
+"""Background checkpoint saving for the training scripts.
+
+save() only copies the state to the CPU, which is quick, and returns; a writer
+thread serializes it to a temporary file and renames it into place, so a crash
+never leaves a truncated checkpoint behind.
+"""
+import os, glob, threading, queue
+import torch
+
+def snapshot(obj):
+    # copies every tensor of a (nested) state dict to the CPU, so training can keep updating the originals
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    keep_last: after each write, only the newest keep_last checkpoints with the same
+    file name prefix (e.g. 'checkpoint_step' or 'disc_checkpoint_step') are kept in
+    their directory; 0 keeps all of them.
+
+    At most max_pending snapshots wait to be written; save() blocks beyond that, which
+    bounds the memory held by snapshots. Errors of the writer are re-raised by the next
+    save() or flush().
+    """
+
+    def __init__(self, keep_last=0, max_pending=2):
+        self.keep_last = keep_last
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while 1:
+            path, state, prefix = self.pending.get()
+            try:
+                self._write(path, state, prefix)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def _write(self, path, state, prefix):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        print("Saved checkpoint:", path)
+
+        if self.keep_last > 0 and prefix is not None:
+            checkpoints = sorted(glob.glob(os.path.join(os.path.dirname(path), glob.escape(prefix) + '*.pth')))
+            for old in checkpoints[:-self.keep_last]:
+                os.remove(old)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, path, state, prefix=None):
+        """Queues state to be saved at path; prefix is the file name prefix that retention applies to."""
+        self._check()
+        self.pending.put((path, snapshot(state), prefix))
+
+    def flush(self):
+        """Waits until every queued checkpoint is on disk."""
+        self.pending.join()
+        self._check()
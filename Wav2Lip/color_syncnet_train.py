@@ -3,6 +3,9 @@ from tqdm import tqdm
 
 from models import SyncNet_color as SyncNet
 import audio
+import shards
+from sample_index import SampleIndex
+from checkpoints import CheckpointWriter
 
 import torch
 from torch import nn
@@ -22,6 +25,8 @@ parser.add_argument("--data_root", help="Root folder of the preprocessed LRS2 da
 
 parser.add_argument('--checkpoint_dir', help='Save checkpoints to this directory', required=True, type=str)
 parser.add_argument('--checkpoint_path', help='Resumed from this checkpoint', default=None, type=str)
+parser.add_argument('--shard_id', help='Train on the shard_id-th of num_shards disjoint parts of the training samples (multi node runs)', default=0, type=int)
+parser.add_argument('--num_shards', help='Number of training sample shards', default=1, type=int)
 
 args = parser.parse_args()
 
@@ -30,6 +35,7 @@ global_step = 0
 global_epoch = 0
 use_cuda = torch.cuda.is_available()
 print('use_cuda: {}'.format(use_cuda))
+checkpoint_writer = CheckpointWriter(keep_last=hparams.keep_checkpoints)
 
 syncnet_T = 5
 syncnet_mel_step_size = 16
@@ -37,8 +43,14 @@ syncnet_mel_step_size = 16
 class Dataset(object):
     def __init__(self, split):
         self.all_videos = get_image_list(args.data_root, split)
+        shard_id, num_shards = (args.shard_id, args.num_shards) if split == 'train' else (0, 1)
+        self.samples = SampleIndex(self.all_videos, args.data_root, syncnet_T, mel_offsets=(0, 0),
+                                   mel_step_size=syncnet_mel_step_size, fps=hparams.fps,
+                                   shard_id=shard_id, num_shards=num_shards)
 
     def get_frame_id(self, frame):
+        if type(frame) == int:
+            return frame # shard frame ids are ints already
         return int(basename(frame).split('.')[0])
 
     def get_window(self, start_frame):
@@ -64,20 +76,14 @@ class Dataset(object):
 
 
     def __len__(self):
-        return len(self.all_videos)
+        return len(self.samples)
 
     def __getitem__(self, idx):
         while 1:
-            idx = random.randint(0, len(self.all_videos) - 1)
-            vidname = self.all_videos[idx]
-
-            img_names = list(glob(join(vidname, '*.jpg')))
-            if len(img_names) <= 3 * syncnet_T:
-                continue
-            img_name = random.choice(img_names)
-            wrong_img_name = random.choice(img_names)
-            while wrong_img_name == img_name:
-                wrong_img_name = random.choice(img_names)
+            vidname, img_name, wrong_img_name = self.samples[idx]
+            # indexed samples are valid; this is only used if the files changed since indexing
+            idx = random.randint(0, len(self.samples) - 1)
+            shard = shards.open_shard(vidname)
 
             if random.choice([True, False]):
                 y = torch.ones(1).float()
@@ -86,36 +92,41 @@ class Dataset(object):
                 y = torch.zeros(1).float()
                 chosen = wrong_img_name
 
-            window_fnames = self.get_window(chosen)
-            if window_fnames is None:
-                continue
-
-            window = []
-            all_read = True
-            for fname in window_fnames:
-                img = cv2.imread(fname)
-                if img is None:
-                    all_read = False
-                    break
-                try:
-                    img = cv2.resize(img, (hparams.img_size, hparams.img_size))
-                except Exception as e:
-                    all_read = False
-                    break
-
-                window.append(img)
-
-            if not all_read: continue
+            if shard is not None:
+                window = shard.window(chosen, syncnet_T)
+                if window is None:
+                    continue
+            else:
+                window_fnames = self.get_window(join(vidname, '{}.jpg'.format(chosen)))
+                if window_fnames is None:
+                    continue
+
+                window = []
+                all_read = True
+                for fname in window_fnames:
+                    img = cv2.imread(fname)
+                    if img is None:
+                        all_read = False
+                        break
+                    try:
+                        img = cv2.resize(img, (hparams.img_size, hparams.img_size))
+                    except Exception as e:
+                        all_read = False
+                        break
+
+                    window.append(img)
+
+                if not all_read: continue
 
             try:
-                wavpath = join(vidname, "audio.wav")
-                wav = audio.load_wav(wavpath, hparams.sample_rate)
-
-                orig_mel = audio.melspectrogram(wav).T
+                if shard is not None and shard.mel is not None:
+                    orig_mel = shard.mel
+                else:
+                    orig_mel = audio.load_mel(join(vidname, "audio.wav"))
             except Exception as e:
                 continue
 
-            mel = self.crop_audio_window(orig_mel.copy(), img_name)
+            mel = self.crop_audio_window(orig_mel, img_name)
 
             if (mel.shape[0] != syncnet_mel_step_size):
                 continue
@@ -210,13 +221,12 @@ def save_checkpoint(model, optimizer, step, checkpoint_dir, epoch):
     checkpoint_path = join(
         checkpoint_dir, "checkpoint_step{:09d}.pth".format(global_step))
     optimizer_state = optimizer.state_dict() if hparams.save_optimizer_state else None
-    torch.save({
+    checkpoint_writer.save(checkpoint_path, {
         "state_dict": model.state_dict(),
         "optimizer": optimizer_state,
         "global_step": step,
         "global_epoch": epoch,
-    }, checkpoint_path)
-    print("Saved checkpoint:", checkpoint_path)
+    }, prefix='checkpoint_step')
 
 def _load(checkpoint_path):
     if use_cuda:
@@ -257,8 +267,9 @@ if __name__ == "__main__":
         train_dataset, batch_size=hparams.syncnet_batch_size, shuffle=True,
         num_workers=hparams.num_workers)
 
+    # eval_model stops after eval_steps batches, shuffle so they cover all the val videos
     test_data_loader = data_utils.DataLoader(
-        test_dataset, batch_size=hparams.syncnet_batch_size,
+        test_dataset, batch_size=hparams.syncnet_batch_size, shuffle=True,
         num_workers=8)
 
     device = torch.device("cuda" if use_cuda else "cpu")
@@ -273,7 +284,17 @@ if __name__ == "__main__":
     if checkpoint_path is not None:
         load_checkpoint(checkpoint_path, model, optimizer, reset_optimizer=False)
 
-    train(device, model, train_data_loader, test_data_loader, optimizer,
-          checkpoint_dir=checkpoint_dir,
-          checkpoint_interval=hparams.syncnet_checkpoint_interval,
-          nepochs=hparams.nepochs)
+    try:
+        train(device, model, train_data_loader, test_data_loader, optimizer,
+              checkpoint_dir=checkpoint_dir,
+              checkpoint_interval=hparams.syncnet_checkpoint_interval,
+              nepochs=hparams.nepochs)
+    except:
+        # also on ctrl+c, so that queued checkpoints are not lost; a failed save must not
+        # hide the exception that stopped training
+        try:
+            checkpoint_writer.flush()
+        except Exception as e:
+            print('Could not save the queued checkpoints: {}'.format(e))
+        raise
+    checkpoint_writer.flush()
@@ -1,7 +1,9 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse
-import dlib, json, subprocess
+import dlib, json, subprocess, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from glob import glob
 import torch
@@ -10,6 +12,9 @@ sys.path.append('../')
 import audio
 import face_detection
 from models import Wav2Lip
+from batching import BatchBuilder, mel_windows
+from videoio import FFmpegWriter, read_frames
+import pipeline
 
 parser = argparse.ArgumentParser(description='Code to generate results for test filelists')
 
@@ -26,6 +31,10 @@ parser.add_argument('--pads', nargs='+', type=int, default=[0, 0, 0, 0],
 parser.add_argument('--face_det_batch_size', type=int, 
 					help='Single GPU batch size for face detection', default=64)
 parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip', default=128)
+parser.add_argument('--prepare_workers', type=int, default=4,
+					help='Threads extracting audio, decoding and detecting faces of upcoming clips')
+parser.add_argument('--write_workers', type=int, default=4,
+					help='Threads pasting generated faces back into the frames')
 
 # parser.add_argument('--resize_factor', default=1, type=int)
 
@@ -41,22 +50,25 @@ def get_smoothened_boxes(boxes, T):
 		boxes[i] = np.mean(window, axis=0)
 	return boxes
 
+detect_lock = threading.Lock() # clips are prepared concurrently, but share the detector
+
 def face_detect(images):
-	batch_size = args.face_det_batch_size
-	
-	while 1:
-		predictions = []
-		try:
-			for i in range(0, len(images), batch_size):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
-		except RuntimeError:
-			if batch_size == 1:
-				raise RuntimeError('Image too big to run face detection on GPU')
-			batch_size //= 2
-			args.face_det_batch_size = batch_size
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
+	with detect_lock:
+		batch_size = args.face_det_batch_size
+
+		while 1:
+			predictions = []
+			try:
+				for i in range(0, len(images), batch_size):
+					predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
+			except RuntimeError:
+				if batch_size == 1:
+					raise RuntimeError('Image too big to run face detection on GPU')
+				batch_size //= 2
+				args.face_det_batch_size = batch_size
+				print('Recovering from OOM error; New batch size: {}'.format(batch_size))
+				continue
+			break
 
 	results = []
 	pady1, pady2, padx1, padx2 = args.pads
@@ -76,50 +88,94 @@ def face_detect(images):
 
 	return results 
 
-def datagen(frames, face_det_results, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	for i, m in enumerate(mels):
-		if i >= len(frames): raise ValueError('Equal or less lengths only')
-
-		frame_to_save = frames[i].copy()
-		face, coords, valid_frame = face_det_results[i].copy()
-		if not valid_frame:
-			continue
-
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
-
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+class Clip(object):
+	"""A filelist entry on its way from preparation through the model to its writer."""
 
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
+	def __init__(self, idx, audio_src, video):
+		self.idx, self.audio_src, self.video = idx, audio_src, video
+		# clips are in flight concurrently, so each needs its own temp audio
+		self.temp_audio = '../temp/temp_{}.wav'.format(idx)
+		self.outfile = os.path.join(args.results_dir, '{}.mp4'.format(idx))
+		self.writer = None
+		self.remaining = 0
 
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+def prepare_clip(clip):
+	# audio, mel windows, frames and faces of clip; None if it is skipped
+	command = ['ffmpeg', '-loglevel', 'panic', '-y', '-i', clip.audio_src, '-strict', '-2', clip.temp_audio]
+	subprocess.call(command)
 
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
-
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-		yield img_batch, mel_batch, frame_batch, coords_batch
+	try:
+		wav = audio.load_wav(clip.temp_audio, 16000)
+		mel = audio.melspectrogram(wav)
+		if np.isnan(mel.reshape(-1)).sum() > 0:
+			raise ValueError('NaN in mel')
+
+		clip.mels = mel_windows(mel, fps, mel_step_size, pad_last=False)
+
+		full_frames = list(read_frames(clip.video, limit=len(clip.mels) + 1))
+		if len(full_frames) < len(clip.mels):
+			raise ValueError('Video shorter than audio')
+
+		clip.frames = full_frames[:len(clip.mels)]
+		clip.faces = face_detect(clip.frames)
+	except ValueError:
+		finish(clip)
+		return None
+
+	return clip
+
+def prepared_clips(clips, pool, depth):
+	# prepares up to depth clips ahead on pool, yields them in filelist order
+	clips = iter(clips)
+	pending = deque(pool.submit(prepare_clip, clip) for clip, _ in zip(clips, range(depth)))
+	while len(pending) > 0:
+		clip = pending.popleft().result()
+		for next_clip in clips:
+			pending.append(pool.submit(prepare_clip, next_clip))
+			break
+		if clip is not None:
+			yield clip
+
+def datagen(clips):
+	# (face, mel window, frame, (clip, coords)) items of consecutive clips for BatchBuilder, so batches span clips
+	for clip in clips:
+		items = [i for i in range(len(clip.mels)) if clip.faces[i][2]]
+		clip.remaining = len(items)
+		if clip.remaining == 0:
+			finish(clip)
+
+		for i in items:
+			face, coords, valid_frame = clip.faces[i]
+			yield face, clip.mels[i], clip.frames[i], (clip, coords)
+
+def paste(pred, frames, coords):
+	for p, f, (clip, c) in zip(pred, frames, coords):
+		y1, y2, x1, x2 = c
+		f[y1:y2, x1:x2] = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+	return frames, coords
+
+def write(result):
+	# runs in batch order, so every clip's frames reach its writer in order
+	for f, (clip, c) in zip(*result):
+		if clip.writer is None:
+			frame_h, frame_w = f.shape[:-1]
+			clip.writer = FFmpegWriter(clip.outfile, fps, (frame_w, frame_h), audio=clip.temp_audio)
+		clip.writer.write(f)
+
+		clip.remaining -= 1
+		if clip.remaining == 0:
+			finish(clip)
+
+def finish(clip):
+	if clip.writer is not None:
+		clip.writer.close()
+	if os.path.exists(clip.temp_audio):
+		os.remove(clip.temp_audio)
+	clip.frames = clip.faces = clip.mels = None
+	prog_bar.update(1)
 
 fps = 25
 mel_step_size = 16
-mel_idx_multiplier = 80./fps
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print('Using {} for inference.'.format(device))
 
@@ -148,8 +204,12 @@ def load_model(path):
 	return model.eval()
 
 model = load_model(args.checkpoint_path)
+# batches wait in a prefetch queue of 2, so the ring needs 2 more buffers
+builder = BatchBuilder(args.wav2lip_batch_size, args.img_size, num_buffers=4)
+prog_bar = None
 
 def main():
+	global prog_bar
 	assert args.data_root is not None
 	data_root = args.data_root
 
@@ -158,81 +218,27 @@ def main():
 	with open(args.filelist, 'r') as filelist:
 		lines = filelist.readlines()
 
-	for idx, line in enumerate(tqdm(lines)):
+	clips = []
+	for idx, line in enumerate(lines):
 		audio_src, video = line.strip().split()
+		clips.append(Clip(idx, os.path.join(data_root, audio_src) + '.mp4', os.path.join(data_root, video) + '.mp4'))
 
-		audio_src = os.path.join(data_root, audio_src) + '.mp4'
-		video = os.path.join(data_root, video) + '.mp4'
-
-		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, '../temp/temp.wav')
-		subprocess.call(command, shell=True)
-		temp_audio = '../temp/temp.wav'
-
-		wav = audio.load_wav(temp_audio, 16000)
-		mel = audio.melspectrogram(wav)
-		if np.isnan(mel.reshape(-1)).sum() > 0:
-			continue
-
-		mel_chunks = []
-		i = 0
-		while 1:
-			start_idx = int(i * mel_idx_multiplier)
-			if start_idx + mel_step_size > len(mel[0]):
-				break
-			mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-			i += 1
-
-		video_stream = cv2.VideoCapture(video)
-			
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading or len(full_frames) > len(mel_chunks):
-				video_stream.release()
-				break
-			full_frames.append(frame)
-
-		if len(full_frames) < len(mel_chunks):
-			continue
-
-		full_frames = full_frames[:len(mel_chunks)]
-
-		try:
-			face_det_results = face_detect(full_frames.copy())
-		except ValueError as e:
-			continue
-
-		batch_size = args.wav2lip_batch_size
-		gen = datagen(full_frames.copy(), face_det_results, mel_chunks)
-
-		for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
-			if i == 0:
-				frame_h, frame_w = full_frames[0].shape[:-1]
-				out = cv2.VideoWriter('../temp/result.avi', 
-								cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
-
-			img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-			mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+	prog_bar = tqdm(total=len(clips))
+	workers = pipeline.OrderedWorkers(paste, write, workers=args.write_workers)
+	with ThreadPoolExecutor(args.prepare_workers) as prepare_pool:
+		items = datagen(prepared_clips(clips, prepare_pool, 2 * args.prepare_workers))
+		for img_batch, mel_batch, frames, coords in pipeline.prefetch(builder.batches(items), 2):
+			img_batch = builder.face_input(torch.from_numpy(img_batch).to(device))
+			mel_batch = torch.from_numpy(mel_batch).to(device).permute(0, 3, 1, 2)
 
 			with torch.no_grad():
 				pred = model(mel_batch, img_batch)
-					
 
 			pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-			
-			for pl, f, c in zip(pred, frames, coords):
-				y1, y2, x1, x2 = c
-				pl = cv2.resize(pl.astype(np.uint8), (x2 - x1, y2 - y1))
-				f[y1:y2, x1:x2] = pl
-				out.write(f)
-
-		out.release()
-
-		vid = os.path.join(args.results_dir, '{}.mp4'.format(idx))
+			workers.submit(pred, frames, coords)
 
-		command = 'ffmpeg -loglevel panic -y -i {} -i {} -strict -2 -q:v 1 {}'.format(temp_audio, 
-								'../temp/result.avi', vid)
-		subprocess.call(command, shell=True)
+	workers.close()
+	prog_bar.close()
 
 if __name__ == '__main__':
 	main()
@@ -10,6 +10,7 @@ sys.path.append('../')
 import audio
 import face_detection
 from models import Wav2Lip
+from batching import BatchBuilder, mel_windows
 
 parser = argparse.ArgumentParser(description='Code to generate results on ReSyncED evaluation set')
 
@@ -106,45 +107,15 @@ def face_detect(images):
 	return results, images 
 
 def datagen(frames, face_det_results, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	for i, m in enumerate(mels):
+	# (face, mel, frame, coords) items for BatchBuilder
+	for i in range(len(mels)):
 		if i >= len(frames): raise ValueError('Equal or less lengths only')
 
-		frame_to_save = frames[i].copy()
-		face, coords, valid_frame = face_det_results[i].copy()
+		face, coords, valid_frame = face_det_results[i]
 		if not valid_frame:
 			continue
 
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
-
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
-
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
-
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-		yield img_batch, mel_batch, frame_batch, coords_batch
+		yield face, i, frames[i].copy(), coords
 
 def increase_frames(frames, l):
 	## evenly duplicating frames to increase length of video
@@ -195,6 +166,7 @@ def load_model(path):
 	return model.eval()
 
 model = load_model(args.checkpoint_path)
+builder = BatchBuilder(args.wav2lip_batch_size, args.img_size)
 
 def main():
 	if not os.path.isdir(args.results_dir): os.makedirs(args.results_dir)
@@ -227,7 +199,6 @@ def main():
 		video_stream = cv2.VideoCapture(video)
 
 		fps = video_stream.get(cv2.CAP_PROP_FPS)
-		mel_idx_multiplier = 80./fps
 
 		full_frames = []
 		while 1:
@@ -245,14 +216,7 @@ def main():
 				frame = cv2.resize(frame, (w, h))
 			full_frames.append(frame)
 
-		mel_chunks = []
-		i = 0
-		while 1:
-			start_idx = int(i * mel_idx_multiplier)
-			if start_idx + mel_step_size > len(mel[0]):
-				break
-			mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-			i += 1
+		mel_chunks = mel_windows(mel, fps, mel_step_size, pad_last=False)
 
 		if len(full_frames) < len(mel_chunks):
 			if args.mode == 'tts':
@@ -269,7 +233,7 @@ def main():
 			continue
 
 		batch_size = args.wav2lip_batch_size
-		gen = datagen(full_frames.copy(), face_det_results, mel_chunks)
+		gen = builder.batches(datagen(full_frames.copy(), face_det_results, mel_chunks), mel_chunks)
 
 		for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
 			if i == 0:
@@ -278,8 +242,8 @@ def main():
 				out = cv2.VideoWriter('../temp/result.avi', 
 								cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
 
-			img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-			mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+			img_batch = builder.face_input(torch.from_numpy(img_batch).to(device))
+			mel_batch = torch.from_numpy(mel_batch).to(device).permute(0, 3, 1, 2)
 
 			with torch.no_grad():
 				pred = model(mel_batch, img_batch)
@@ -22,26 +22,69 @@ def calc_pdist(feat1, feat2, vshift=10):
 
     feat2p = torch.nn.functional.pad(feat2,(0,0,vshift,vshift))
 
-    dists = []
-
-    for i in range(0,len(feat1)):
-
-        dists.append(torch.nn.functional.pairwise_distance(feat1[[i],:].repeat(win_size, 1), feat2p[i:i+win_size,:]))
-
-    return dists
+    # T, D, win_size: the audio feats at every offset around each video feat
+    feat2w = feat2p.unfold(0,win_size,1)[:len(feat1)]
+    feat2sq = (feat2p*feat2p).sum(1).unfold(0,win_size,1)[:len(feat1)]
+
+    # T, win_size distances |feat1 + eps - feat2|, as pairwise_distance computes them (eps 1e-6),
+    # expanded to |x|^2 + |y|^2 - 2 x.y so the bulk of the work is one batched matmul
+    feat1e = feat1 + 1e-6
+    sqdist = (feat1e*feat1e).sum(1,keepdim=True) + feat2sq - 2*torch.bmm(feat1e.unsqueeze(1),feat2w).squeeze(1)
+
+    return sqdist.clamp(min=0).sqrt()
+
+# ==================== LOAD INPUTS ====================
+
+def load_frames(videofile, size=None):
+    # decodes straight into one preallocated uint8 (N, H, W, 3) array, resizing to size x size if given
+    cap = cv2.VideoCapture(videofile)
+    capacity = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 1)
+
+    frames = None
+    n = 0
+    while True:
+        ret, image = cap.read()
+        if not ret:
+            break
+
+        if frames is None:
+            shape = image.shape if size is None else (size, size, 3)
+            frames = numpy.empty((capacity,) + shape, dtype=numpy.uint8)
+        elif n == len(frames):
+            # the container's frame count was too low
+            frames = numpy.concatenate([frames, numpy.empty_like(frames)])
+
+        if size is None:
+            frames[n] = image
+        else:
+            cv2.resize(image, (size, size), dst=frames[n])
+        n += 1
+
+    cap.release()
+    if frames is None:
+        raise ValueError('Could not read any frame of %s' % videofile)
+    return frames[:n]
+
+def lip_windows(frames, start, stop, device):
+    # (stop - start, 3, 5, H, W) float windows of the frames start .. stop + 3, converted on device
+    im = torch.from_numpy(frames[start:stop+4]).to(device)
+    im = im.permute(3,0,1,2).unfold(1,5,1)              # 3, stop - start, H, W, 5
+    return im.permute(1,0,4,2,3).float()
 
 # ==================== MAIN DEF ====================
 
 class SyncNetInstance(torch.nn.Module):
 
-    def __init__(self, dropout = 0, num_layers_in_fc_layers = 1024):
+    def __init__(self, dropout = 0, num_layers_in_fc_layers = 1024, device = None):
         super(SyncNetInstance, self).__init__();
 
-        self.__S__ = S(num_layers_in_fc_layers = num_layers_in_fc_layers).cuda();
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device);
+        self.__S__ = S(num_layers_in_fc_layers = num_layers_in_fc_layers).to(self.device);
 
-    def evaluate(self, opt, videofile):
-
-        self.__S__.eval();
+    def load_inputs(self, opt, videofile):
+        # frames, MFCC windows and usable length of videofile; uses no model state, so it can run on worker threads
 
         # ========== ==========
         # Convert files
@@ -52,9 +95,6 @@ class SyncNetInstance(torch.nn.Module):
 
         os.makedirs(os.path.join(opt.tmp_dir,opt.reference))
 
-        command = ("ffmpeg -loglevel error -y -i %s -threads 1 -f image2 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'%06d.jpg'))) 
-        output = subprocess.call(command, shell=True, stdout=None)
-
         command = ("ffmpeg -loglevel error -y -i %s -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 %s" % (videofile,os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))) 
         output = subprocess.call(command, shell=True, stdout=None)
         
@@ -62,32 +102,17 @@ class SyncNetInstance(torch.nn.Module):
         # Load video 
         # ========== ==========
 
-        images = []
-        
-        flist = glob.glob(os.path.join(opt.tmp_dir,opt.reference,'*.jpg'))
-        flist.sort()
-
-        for fname in flist:
-            img_input = cv2.imread(fname)
-            img_input = cv2.resize(img_input, (224,224)) #HARD CODED, CHANGE BEFORE RELEASE
-            images.append(img_input)
-
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
-
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
+        images = load_frames(videofile, 224) #HARD CODED, CHANGE BEFORE RELEASE
 
         # ========== ==========
         # Load audio
         # ========== ==========
 
         sample_rate, audio = wavfile.read(os.path.join(opt.tmp_dir,opt.reference,'audio.wav'))
-        mfcc = zip(*python_speech_features.mfcc(audio,sample_rate))
-        mfcc = numpy.stack([numpy.array(i) for i in mfcc])
+        mfcc = python_speech_features.mfcc(audio,sample_rate).T
 
-        cc = numpy.expand_dims(numpy.expand_dims(mfcc,axis=0),axis=0)
-        cct = torch.autograd.Variable(torch.from_numpy(cc.astype(float)).float())
+        # (N, 1, 13, 20) MFCC windows, 4 MFCC steps (one video frame) apart
+        cct = torch.from_numpy(mfcc.astype(numpy.float32)).unfold(1,20,4).permute(1,0,2).unsqueeze(1)
 
         # ========== ==========
         # Check audio and video input length
@@ -97,6 +122,16 @@ class SyncNetInstance(torch.nn.Module):
         #    print("WARNING: Audio (%.4fs) and video (%.4fs) lengths are different."%(float(len(audio))/16000,float(len(images))/25))
 
         min_length = min(len(images),math.floor(len(audio)/640))
+
+        return images, cct, min_length
+
+    def evaluate(self, opt, videofile, inputs = None):
+
+        self.__S__.eval();
+
+        if inputs is None:
+            inputs = self.load_inputs(opt, videofile)
+        images, cct, min_length = inputs
         
         # ========== ==========
         # Generate video and audio feats
@@ -107,17 +142,15 @@ class SyncNetInstance(torch.nn.Module):
         cc_feat = []
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lip(im_in.cuda());
-            im_feat.append(im_out.data.cpu())
+        with torch.no_grad():
+            for i in range(0,lastframe,opt.batch_size):
+                stop = min(lastframe,i+opt.batch_size)
+
+                im_out  = self.__S__.forward_lip(lip_windows(images, i, stop, self.device));
+                im_feat.append(im_out.cpu())
 
-            cc_batch = [ cct[:,:,:,vframe*4:vframe*4+20] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            cc_in = torch.cat(cc_batch,0)
-            cc_out  = self.__S__.forward_aud(cc_in.cuda())
-            cc_feat.append(cc_out.data.cpu())
+                cc_out  = self.__S__.forward_aud(cct[i:stop].to(self.device))
+                cc_feat.append(cc_out.cpu())
 
         im_feat = torch.cat(im_feat,0)
         cc_feat = torch.cat(cc_feat,0)
@@ -129,14 +162,14 @@ class SyncNetInstance(torch.nn.Module):
         #print('Compute time %.3f sec.' % (time.time()-tS))
 
         dists = calc_pdist(im_feat,cc_feat,vshift=opt.vshift)
-        mdist = torch.mean(torch.stack(dists,1),1)
+        mdist = torch.mean(dists,0)
 
         minval, minidx = torch.min(mdist,0)
 
         offset = opt.vshift-minidx
         conf   = torch.median(mdist) - minval
 
-        fdist   = numpy.stack([dist[minidx].numpy() for dist in dists])
+        fdist   = dists[:,minidx].numpy()
         # fdist   = numpy.pad(fdist, (3,3), 'constant', constant_values=15)
         fconf   = torch.median(mdist).numpy() - fdist
         fconfm  = signal.medfilt(fconf,kernel_size=9)
@@ -146,7 +179,7 @@ class SyncNetInstance(torch.nn.Module):
         #print(fconfm)
         #print('AV offset: \t%d \nMin dist: \t%.3f\nConfidence: \t%.3f' % (offset,minval,conf))
 
-        dists_npy = numpy.array([ dist.numpy() for dist in dists ])
+        dists_npy = dists.numpy()
         return offset.numpy(), conf.numpy(), minval.numpy()
 
     def extract_feature(self, opt, videofile):
@@ -156,24 +189,8 @@ class SyncNetInstance(torch.nn.Module):
         # ========== ==========
         # Load video 
         # ========== ==========
-        cap = cv2.VideoCapture(videofile)
+        images = load_frames(videofile)
 
-        frame_num = 1;
-        images = []
-        while frame_num:
-            frame_num += 1
-            ret, image = cap.read()
-            if ret == 0:
-                break
-
-            images.append(image)
-
-        im = numpy.stack(images,axis=3)
-        im = numpy.expand_dims(im,axis=0)
-        im = numpy.transpose(im,(0,3,4,1,2))
-
-        imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
-        
         # ========== ==========
         # Generate video feats
         # ========== ==========
@@ -182,12 +199,12 @@ class SyncNetInstance(torch.nn.Module):
         im_feat = []
 
         tS = time.time()
-        for i in range(0,lastframe,opt.batch_size):
-            
-            im_batch = [ imtv[:,:,vframe:vframe+5,:,:] for vframe in range(i,min(lastframe,i+opt.batch_size)) ]
-            im_in = torch.cat(im_batch,0)
-            im_out  = self.__S__.forward_lipfeat(im_in.cuda());
-            im_feat.append(im_out.data.cpu())
+        with torch.no_grad():
+            for i in range(0,lastframe,opt.batch_size):
+                stop = min(lastframe,i+opt.batch_size)
+
+                im_out  = self.__S__.forward_lipfeat(lip_windows(images, i, stop, self.device));
+                im_feat.append(im_out.cpu())
 
         im_feat = torch.cat(im_feat,0)
 
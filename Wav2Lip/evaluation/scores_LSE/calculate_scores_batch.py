@@ -0,0 +1,182 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import time, argparse, subprocess, os, glob, json, csv, copy, re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from SyncNetInstance_calc_scores import *
+
+# ==================== PARSE ARGUMENT ====================
+
+parser = argparse.ArgumentParser(description = "SyncNet");
+parser.add_argument('--initial_model', type=str, default="data/syncnet_v2.model", help='');
+parser.add_argument('--batch_size', type=int, default='20', help='');
+parser.add_argument('--vshift', type=int, default='15', help='');
+parser.add_argument('--videos', type=str, required=True, help='Folder of .mp4 videos, or a text file with one video path per line');
+parser.add_argument('--data_dir', type=str, default='tmp_dir', help='Scratch folder for extracted audio and face crops');
+parser.add_argument('--results', type=str, default='all_scores.jsonl', help='Results table (.jsonl or .csv). Videos already scored in it are skipped');
+parser.add_argument('--crop_faces', action='store_true', help='Score the face tracks run_pipeline.py crops from each video (real videos), instead of the whole frames (LRS test sets)');
+parser.add_argument('--workers', type=int, default=4, help='Threads decoding videos (and cropping faces) ahead of the model');
+parser.add_argument('--device', type=str, default=None, help='Defaults to cuda if available');
+opt = parser.parse_args();
+
+fields = ['video', 'track', 'status', 'offset', 'confidence', 'min_dist', 'frames', 'load_seconds', 'score_seconds', 'error']
+
+# ==================== RESULTS TABLE ====================
+
+def read_results(path):
+    if not os.path.isfile(path):
+        return []
+
+    with open(path) as f:
+        if path.endswith('.csv'):
+            return list(csv.DictReader(f))
+
+        rows = []
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue # a line cut short by a crash
+        return rows
+
+class ResultsWriter(object):
+
+    def __init__(self, path):
+        self.csv = path.endswith('.csv')
+        new = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a')
+        if self.csv:
+            self.writer = csv.DictWriter(self.file, fieldnames=fields)
+            if new:
+                self.writer.writeheader()
+
+    def write(self, row):
+        if self.csv:
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# ==================== LOAD INPUTS ====================
+
+def list_videos(videos):
+    if os.path.isdir(videos):
+        return sorted(glob.glob(os.path.join(videos, '*.mp4')))
+
+    with open(videos) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def job_opt(idx, videofile):
+    # every video gets its own scratch folders, so that jobs can run concurrently
+    job = copy.copy(opt)
+    job.reference = '%06d_%s' % (idx, re.sub(r'[^\w.-]', '_', os.path.splitext(os.path.basename(videofile))[0]))
+    job.tmp_dir = os.path.join(opt.data_dir, 'pytmp')
+    return job
+
+def load(s, job, videofile):
+    # [(track, inputs or exception, load seconds)] of a video, computed on a worker thread
+    tS = time.time()
+    if not opt.crop_faces:
+        tracks = [(None, videofile)]
+    else:
+        command = ['python', 'run_pipeline.py', '--videofile', videofile, '--reference', job.reference, '--data_dir', opt.data_dir]
+        if subprocess.call(command) != 0:
+            raise RuntimeError('run_pipeline.py failed on %s' % videofile)
+        flist = sorted(glob.glob(os.path.join(opt.data_dir, 'pycrop', job.reference, '0*.avi')))
+        tracks = [(os.path.splitext(os.path.basename(fname))[0], fname) for fname in flist]
+
+    inputs = []
+    for track, fname in tracks:
+        track_job = copy.copy(job)
+        if track is not None:
+            track_job.reference = job.reference + '_' + track
+        try:
+            inputs.append((track, s.load_inputs(track_job, fname), time.time() - tS))
+        except Exception as e:
+            inputs.append((track, e, time.time() - tS))
+        tS = time.time()
+    return inputs
+
+def cleanup(job):
+    for folder in ['pyavi', 'pytmp', 'pywork', 'pycrop', 'pyframes']:
+        for path in glob.glob(os.path.join(opt.data_dir, folder, job.reference + '*')):
+            rmtree(path, ignore_errors=True)
+
+# ==================== LOAD MODEL AND FILE LIST ====================
+
+s = SyncNetInstance(device = opt.device);
+
+s.loadParameters(opt.initial_model);
+
+scored = set(row['video'] for row in read_results(opt.results) if row['status'] == 'ok')
+all_videos = list_videos(opt.videos)
+jobs = [(idx, videofile) for idx, videofile in enumerate(all_videos) if videofile not in scored]
+print('Scoring %d videos, %d already scored in %s' % (len(jobs), len(all_videos) - len(jobs), opt.results))
+
+# ==================== SCORE ====================
+
+results = ResultsWriter(opt.results)
+pool = ThreadPoolExecutor(opt.workers)
+pending = deque()
+prog_bar = tqdm(total=len(jobs))
+jobs = iter(jobs)
+
+def submit():
+    for idx, videofile in jobs:
+        job = job_opt(idx, videofile)
+        pending.append((videofile, job, pool.submit(load, s, job, videofile)))
+        return
+
+# decode up to 2 videos per worker ahead of the model, results are written in input order
+for _ in range(2 * opt.workers):
+    submit()
+
+while len(pending) > 0:
+    videofile, job, future = pending.popleft()
+    submit()
+
+    try:
+        tracks = future.result()
+    except Exception as e:
+        tracks = [(None, e, 0.)]
+    if len(tracks) == 0:
+        tracks = [(None, RuntimeError('no face track found'), 0.)]
+
+    for track, inputs, load_seconds in tracks:
+        row = dict(video=videofile, track=track, load_seconds=round(load_seconds, 3))
+        if isinstance(inputs, Exception):
+            row.update(status='error', error=repr(inputs))
+        else:
+            tS = time.time()
+            try:
+                offset, conf, dist = s.evaluate(job, videofile, inputs=inputs)
+                row.update(status='ok', offset=int(offset), confidence=float(conf), min_dist=float(dist), frames=int(inputs[2]))
+            except Exception as e:
+                row.update(status='error', error=repr(e))
+            row['score_seconds'] = round(time.time() - tS, 3)
+        results.write(row)
+
+    cleanup(job)
+    prog_bar.update(1)
+
+prog_bar.close()
+pool.shutdown()
+results.close()
+
+# ==================== PRINT RESULTS ====================
+
+all_rows = read_results(opt.results)
+rows = [row for row in all_rows if row['status'] == 'ok']
+if len(rows) > 0:
+    print ('Average Confidence: {}'.format(sum(float(row['confidence']) for row in rows) / len(rows)))
+    print ('Average Minimum Distance: {}'.format(sum(float(row['min_dist']) for row in rows) / len(rows)))
+
+failed = set(row['video'] for row in all_rows) - set(row['video'] for row in rows)
+if len(failed) > 0:
+    print ('{} videos failed, rerun to retry them'.format(len(failed)))
@@ -1,8 +1,2 @@
-rm all_scores.txt
-yourfilenames=`ls $1`
-
-for eachfile in $yourfilenames
-do
-   python run_pipeline.py --videofile $1/$eachfile --reference wav2lip --data_dir tmp_dir
-   python calculate_scores_real_videos.py --videofile $1/$eachfile --reference wav2lip --data_dir tmp_dir >> all_scores.txt
-done
+# scores every video in $1 once, appending to all_scores.csv; rerun to score only videos not in it yet
+python calculate_scores_batch.py --videos $1 --crop_faces --data_dir tmp_dir --results all_scores.csv
@@ -45,11 +45,14 @@ ROOT = os.path.dirname(os.path.abspath(__file__))
 
 class FaceAlignment:
     def __init__(self, landmarks_type, network_size=NetworkSize.LARGE,
-                 device='cuda', flip_input=False, face_detector='sfd', verbose=False):
+                 device='cuda', flip_input=False, face_detector='sfd', verbose=False, max_side=None,
+                 nms_top_k=None):
         self.device = device
         self.flip_input = flip_input
         self.landmarks_type = landmarks_type
         self.verbose = verbose
+        # Detect on a copy downscaled to at most this many pixels on its longer side, None for full resolution
+        self.max_side = max_side
 
         network_size = int(network_size)
 
@@ -60,8 +63,24 @@ class FaceAlignment:
         face_detector_module = __import__('face_detection.detection.' + face_detector,
                                           globals(), locals(), [face_detector], 0)
         self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
+        self.nms_top_k = nms_top_k
+
+    @property
+    def nms_top_k(self):
+        # NMS candidates per image of the sfd detector, None for all; a limit can change the detections
+        return self.face_detector.nms_top_k
+
+    @nms_top_k.setter
+    def nms_top_k(self, top_k):
+        self.face_detector.nms_top_k = top_k
 
     def get_detections_for_batch(self, images):
+        scale = 1.
+        if self.max_side and max(images.shape[1:3]) > self.max_side:
+            scale = float(self.max_side) / max(images.shape[1:3])
+            size = (int(round(images.shape[2] * scale)), int(round(images.shape[1] * scale)))
+            images = np.stack([cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in images])
+
         images = images[..., ::-1]
         detected_faces = self.face_detector.detect_from_batch(images.copy())
         results = []
@@ -72,7 +91,8 @@ class FaceAlignment:
                 continue
             d = d[0]
             d = np.clip(d, 0, None)
-            
+            d[:-1] /= scale
+
             x1, y1, x2, y2 = map(int, d[:-1])
             results.append((x1, y1, x2, y2))
 
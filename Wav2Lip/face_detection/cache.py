@@ -0,0 +1,76 @@
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+
+
+class BoxCache(object):
+    """On-disk cache of per-frame face boxes, keyed by the content of the source file.
+
+    Each entry is a small ``.npz`` holding an ``(N, 4)`` array with the boxes of the
+    first N frames and whether those N frames are the whole video. Changing the file
+    changes its hash, so stale entries are never hit; they simply age out. The cache
+    keeps the ``max_entries`` most recently used entries (by file modification time).
+    """
+
+    version = 1
+
+    def __init__(self, cache_dir, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._file_hashes = {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        if memo_key not in self._file_hashes:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            self._file_hashes[memo_key] = sha.hexdigest()
+        return self._file_hashes[memo_key]
+
+    def key(self, path, **params):
+        params = dict(params, file=self.file_hash(path), version=self.version)
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key, num_frames):
+        """Returns the boxes of the first ``num_frames`` frames, or None if they are not cached.
+
+        Fewer boxes are returned when the cached entry covers a whole video shorter than that.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                boxes, complete = entry['boxes'], bool(entry['complete'])
+        except (IOError, ValueError, KeyError):
+            return None
+
+        if len(boxes) < num_frames and not complete:
+            return None
+
+        os.utime(path, None)
+        return boxes[:num_frames]
+
+    def save(self, key, boxes, complete=False):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, boxes=np.asarray(boxes, dtype=np.int32), complete=complete)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = sorted(glob.glob(os.path.join(self.cache_dir, '*.npz')), key=os.path.getmtime)
+        for path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -64,6 +64,47 @@ def nms(dets, thresh):
     return keep
 
 
+def batch_nms(dets, thresh, score_thresh=0.0, top_k=None):
+    """Greedy NMS of every image of a batch at once, on the device the detections live on.
+
+    Args:
+        dets: (tensor) Detections (x1, y1, x2, y2, score), Shape: [B, num_dets, 5].
+        thresh: (float) IoU above which a lower scoring box is suppressed.
+        score_thresh: (float) Boxes scoring at or below this are dropped before NMS.
+            They could only ever suppress boxes that score even lower.
+        top_k: (int) If given, only the top_k highest scoring boxes per image are considered.
+            This bounds the k x k overlap matrix on busy images, but when more than top_k
+            boxes pass score_thresh the kept boxes can differ from ``nms``. None considers all.
+    Return:
+        list of B tensors of kept detections sorted by descending score, as ``nms`` would keep them
+        (unless top_k cut off candidates).
+    """
+    B = dets.size(0)
+    valid = dets[:, :, 4] > score_thresh
+    k = int(valid.sum(1).max())
+    if top_k is not None:
+        k = min(top_k, k)
+    if k == 0:
+        return [dets.new_zeros((0, 5)) for _ in range(B)]
+
+    scores, order = dets[:, :, 4].masked_fill(~valid, -1).topk(k, dim=1)
+    dets = dets.gather(1, order.unsqueeze(2).expand(B, k, 5))
+    x1, y1, x2, y2 = dets[:, :, 0], dets[:, :, 1], dets[:, :, 2], dets[:, :, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    w = (torch.min(x2.unsqueeze(2), x2.unsqueeze(1)) - torch.max(x1.unsqueeze(2), x1.unsqueeze(1)) + 1).clamp(min=0)
+    h = (torch.min(y2.unsqueeze(2), y2.unsqueeze(1)) - torch.max(y1.unsqueeze(2), y1.unsqueeze(1)) + 1).clamp(min=0)
+    ovr = w * h / (areas.unsqueeze(2) + areas.unsqueeze(1) - w * h)
+    # box i can only suppress the lower scoring boxes after it
+    suppresses = (ovr > thresh) & torch.ones(k, k, dtype=torch.bool, device=dets.device).triu(1)
+
+    keep = scores > score_thresh
+    for i in range(k):
+        keep &= ~(suppresses[:, i] & keep[:, i:i + 1])
+
+    return [d[m] for d, m in zip(dets, keep)]
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -17,45 +17,29 @@ from .bbox import *
 
 
 def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
+    return batch_detect(net, img[np.newaxis], device)[:, 0]
 
-    if 'cuda' in device:
-        torch.backends.cudnn.benchmark = True
+_anchor_grids = {}
 
-    img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
-    with torch.no_grad():
-        olist = net(img)
+def anchor_grid(stride, FH, FW, device):
+    """Prior boxes (cx, cy, w, h) of every position of a stride's feature map, in row-major order."""
+    key = (stride, FH, FW, str(device))
+    if key not in _anchor_grids:
+        cx = (torch.arange(FW, dtype=torch.float32) * stride + stride / 2).view(1, FW).expand(FH, FW)
+        cy = (torch.arange(FH, dtype=torch.float32) * stride + stride / 2).view(FH, 1).expand(FH, FW)
+        wh = torch.full((FH, FW), stride * 4, dtype=torch.float32)
+        _anchor_grids[key] = torch.stack([cx, cy, wh, wh], dim=2).view(-1, 4).to(device)
+    return _anchor_grids[key]
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
+def batch_detect(net, imgs, device):
+    bboxlist = batch_detect_tensor(net, imgs, device)
     if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, 5))
+        return np.zeros((1, bboxlist.size(1), 5))
 
-    return bboxlist
+    return bboxlist.cpu().numpy()
 
-def batch_detect(net, imgs, device):
+def batch_detect_tensor(net, imgs, device):
+    """Like batch_detect, but keeps the (N, B, 5) detections on the network's device (N may be 0)."""
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -68,30 +52,27 @@ def batch_detect(net, imgs, device):
         olist = net(imgs)
 
     bboxlist = []
+    variances = [0.1, 0.2]
     for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+        ocls, oreg = F.softmax(olist[i * 2], dim=1), olist[i * 2 + 1]
         FB, FC, FH, FW = ocls.size()  # feature map size
         stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
+
+        # decode every position that passes the threshold in any image of the batch, for all images
+        scores = ocls[:, 1].reshape(BB, FH * FW)
+        poss = (scores > 0.05).any(dim=0).nonzero().view(-1)
+        if len(poss) == 0:
+            continue
+
+        priors = anchor_grid(stride, FH, FW, imgs.device)[poss].unsqueeze(1)  # K, 1, 4
+        loc = oreg.reshape(BB, 4, FH * FW)[:, :, poss].permute(2, 0, 1)        # K, B, 4
+        box = batch_decode(loc, priors, variances)
+        bboxlist.append(torch.cat([box, scores[:, poss].t().unsqueeze(2)], 2))
+
     if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
+        return imgs.new_zeros((0, BB, 5))
 
-    return bboxlist
+    return torch.cat(bboxlist, 0)
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
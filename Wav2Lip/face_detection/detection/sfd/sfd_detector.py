@@ -28,23 +28,24 @@ class SFDDetector(FaceDetector):
         self.face_detector.to(device)
         self.face_detector.eval()
 
+        # candidates per image considered by NMS; None considers all of them, as nms() did.
+        # A limit (inference.py --face_det_nms_top_k, preprocess.py --nms_top_k) bounds NMS time
+        # on busy frames but can change which boxes survive.
+        self.nms_top_k = None
+
     def detect_from_image(self, tensor_or_path):
         image = self.tensor_or_path_to_ndarray(tensor_or_path)
 
-        bboxlist = detect(self.face_detector, image, device=self.device)
-        keep = nms(bboxlist, 0.3)
-        bboxlist = bboxlist[keep, :]
-        bboxlist = [x for x in bboxlist if x[-1] > 0.5]
-
-        return bboxlist
+        return self.detect_from_batch(image[np.newaxis])[0]
 
     def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+        bboxlists = batch_detect_tensor(self.face_detector, images, device=self.device)
+        keeps = batch_nms(bboxlists.transpose(0, 1), 0.3, score_thresh=0.5, top_k=self.nms_top_k)
 
-        return bboxlists
+        # a single device to host copy for the whole batch
+        counts = [len(keep) for keep in keeps]
+        bboxlists = torch.cat(keeps, 0).cpu().numpy()
+        return np.split(bboxlists, np.cumsum(counts)[:-1])
 
     @property
     def reference_scale(self):
@@ -0,0 +1,101 @@
+import numpy as np
+import cv2
+
+
+class FaceTracker(object):
+    """Runs the face detector only on keyframes and propagates the box in between.
+
+    Wraps a detector with a ``get_detections_for_batch`` method (e.g. ``FaceAlignment``)
+    and exposes the same method, so consecutive batches of a video can be fed to it
+    unchanged. Every ``keyframe_interval``-th frame is detected, as is any frame after a
+    scene change. Other frames shift the last detected box to the best template match
+    of the keyframe face near its previous position, falling back to the detector when
+    the match scores below ``min_confidence``.
+
+    The tracking state lives in ``state`` and is only replaced once a whole batch has
+    been processed, so a batch that fails (e.g. out of memory) can simply be retried.
+    """
+
+    def __init__(self, detector, keyframe_interval=10, min_confidence=0.6, scene_change_thresh=30.,
+                 search_margin=0.25, template_size=64):
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        self.min_confidence = min_confidence
+        self.scene_change_thresh = scene_change_thresh
+        self.search_margin = search_margin
+        self.template_size = template_size
+        self.reset()
+
+    def reset(self):
+        # (frames seen, last box, keyframe face template, template scale, last frame thumbnail)
+        self.state = (0, None, None, 1., None)
+        self.detected_frames = 0
+        self.tracked_frames = 0
+
+    @staticmethod
+    def _thumbnail(image):
+        return cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def _template(self, image, box):
+        x1, y1, x2, y2 = box
+        scale = min(1., float(self.template_size) / max(x2 - x1, y2 - y1, 1))
+        face = cv2.cvtColor(image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+        return cv2.resize(face, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+    def _track(self, image, box, template, scale):
+        x1, y1, x2, y2 = box
+        w, h = x2 - x1, y2 - y1
+        mx, my = int(w * self.search_margin), int(h * self.search_margin)
+        sx1, sy1 = max(0, x1 - mx), max(0, y1 - my)
+        sx2, sy2 = min(image.shape[1], x2 + mx), min(image.shape[0], y2 + my)
+
+        region = cv2.cvtColor(image[sy1:sy2, sx1:sx2], cv2.COLOR_BGR2GRAY)
+        region = cv2.resize(region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+            return None, 0.
+
+        _, confidence, _, (px, py) = cv2.minMaxLoc(cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED))
+        nx1, ny1 = sx1 + int(round(px / scale)), sy1 + int(round(py / scale))
+        nx1 = min(max(nx1, 0), image.shape[1] - w)
+        ny1 = min(max(ny1, 0), image.shape[0] - h)
+        return (nx1, ny1, nx1 + w, ny1 + h), confidence
+
+    def get_detections_for_batch(self, images):
+        frame_index, box, template, scale, thumb = self.state
+
+        # scheduled keyframes of this batch are detected together
+        keyframes = [i for i in range(len(images)) if (frame_index + i) % self.keyframe_interval == 0]
+        detections = {}
+        if len(keyframes) > 0:
+            detections = dict(zip(keyframes, self.detector.get_detections_for_batch(images[keyframes])))
+
+        results = []
+        detected, tracked = len(keyframes), 0
+        for i, image in enumerate(images):
+            new_thumb = self._thumbnail(image)
+            if i in detections:
+                new_box = detections[i]
+                refresh = True
+            else:
+                new_box, confidence = None, 0.
+                scene_change = thumb is None or np.abs(new_thumb - thumb).mean() > self.scene_change_thresh
+                if box is not None and not scene_change:
+                    new_box, confidence = self._track(image, box, template, scale)
+
+                refresh = new_box is None or confidence < self.min_confidence
+                if refresh:
+                    new_box = self.detector.get_detections_for_batch(images[i:i + 1])[0]
+                    detected += 1
+                else:
+                    tracked += 1
+
+            if refresh and new_box is not None:
+                template, scale = self._template(image, new_box)
+
+            box, thumb = new_box, new_thumb
+            results.append(new_box)
+
+        self.state = (frame_index + len(images), box, template, scale, thumb)
+        self.detected_frames += detected
+        self.tracked_frames += tracked
+        return results
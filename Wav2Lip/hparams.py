@@ -78,11 +78,12 @@ hparams = HParams(
 	
 	batch_size=16,
 	initial_learning_rate=1e-4,
-	nepochs=200000000000000000,  ### ctrl + c, stop whenever eval loss is consistently greater than train loss for ~10 epochs
+	nepochs=200000000000000000,  ### ctrl + c, stop whenever eval loss is consistently greater than train loss for ~10 evals (an epoch is a pass over every training window, not every video)
 	num_workers=16,
 	checkpoint_interval=3000,
 	eval_interval=3000,
     save_optimizer_state=True,
+	keep_checkpoints=0, # keep only the newest N checkpoints of each model, 0 keeps all
 
     syncnet_wt=0.0, # is initially zero, will be set automatically to 0.03 later. Leads to faster convergence. 
 	syncnet_batch_size=64,
@@ -4,6 +4,9 @@ from tqdm import tqdm
 from models import SyncNet_color as SyncNet
 from models import Wav2Lip, Wav2Lip_disc_qual
 import audio
+import shards
+from sample_index import SampleIndex
+from checkpoints import CheckpointWriter
 
 import torch
 from torch import nn
@@ -15,7 +18,7 @@ import numpy as np
 
 from glob import glob
 
-import os, random, cv2, argparse
+import os, random, cv2, argparse, time
 from hparams import hparams, get_image_list
 
 parser = argparse.ArgumentParser(description='Code to train the Wav2Lip model WITH the visual quality discriminator')
@@ -27,6 +30,13 @@ parser.add_argument('--syncnet_checkpoint_path', help='Load the pre-trained Expe
 
 parser.add_argument('--checkpoint_path', help='Resume generator from this checkpoint', default=None, type=str)
 parser.add_argument('--disc_checkpoint_path', help='Resume quality disc from this checkpoint', default=None, type=str)
+parser.add_argument('--shard_id', help='Train on the shard_id-th of num_shards disjoint parts of the training samples (multi node runs)', default=0, type=int)
+parser.add_argument('--num_shards', help='Number of training sample shards', default=1, type=int)
+parser.add_argument('--precision', help='Autocast precision of the training step; fp16 uses loss scaling and needs a GPU',
+                    default='fp32', choices=['fp32', 'bf16', 'fp16'])
+parser.add_argument('--compile', help='torch.compile the generator and the quality discriminator', action='store_true')
+parser.add_argument('--log_interval', help='Steps between progress bar updates, the only time losses are copied off the GPU',
+                    default=10, type=int)
 
 args = parser.parse_args()
 
@@ -35,6 +45,7 @@ global_step = 0
 global_epoch = 0
 use_cuda = torch.cuda.is_available()
 print('use_cuda: {}'.format(use_cuda))
+checkpoint_writer = CheckpointWriter(keep_last=hparams.keep_checkpoints)
 
 syncnet_T = 5
 syncnet_mel_step_size = 16
@@ -42,8 +53,14 @@ syncnet_mel_step_size = 16
 class Dataset(object):
     def __init__(self, split):
         self.all_videos = get_image_list(args.data_root, split)
+        shard_id, num_shards = (args.shard_id, args.num_shards) if split == 'train' else (0, 1)
+        self.samples = SampleIndex(self.all_videos, args.data_root, syncnet_T, mel_offsets=(-1, 3),
+                                   mel_step_size=syncnet_mel_step_size, fps=hparams.fps,
+                                   shard_id=shard_id, num_shards=num_shards)
 
     def get_frame_id(self, frame):
+        if type(frame) == int:
+            return frame # shard frame ids are ints already
         return int(basename(frame).split('.')[0])
 
     def get_window(self, start_frame):
@@ -74,6 +91,11 @@ class Dataset(object):
 
         return window
 
+    def load_window(self, vidname, shard, start_id):
+        if shard is not None:
+            return shard.window(start_id, syncnet_T)
+        return self.read_window(self.get_window(join(vidname, '{}.jpg'.format(start_id))))
+
     def crop_audio_window(self, spec, start_frame):
         if type(start_frame) == int:
             start_frame_num = start_frame
@@ -108,48 +130,37 @@ class Dataset(object):
         return x
 
     def __len__(self):
-        return len(self.all_videos)
+        return len(self.samples)
 
     def __getitem__(self, idx):
         while 1:
-            idx = random.randint(0, len(self.all_videos) - 1)
-            vidname = self.all_videos[idx]
-            img_names = list(glob(join(vidname, '*.jpg')))
-            if len(img_names) <= 3 * syncnet_T:
-                continue
-            
-            img_name = random.choice(img_names)
-            wrong_img_name = random.choice(img_names)
-            while wrong_img_name == img_name:
-                wrong_img_name = random.choice(img_names)
-
-            window_fnames = self.get_window(img_name)
-            wrong_window_fnames = self.get_window(wrong_img_name)
-            if window_fnames is None or wrong_window_fnames is None:
-                continue
+            vidname, img_name, wrong_img_name = self.samples[idx]
+            # indexed samples are valid; this is only used if the files changed since indexing
+            idx = random.randint(0, len(self.samples) - 1)
+            shard = shards.open_shard(vidname)
 
-            window = self.read_window(window_fnames)
+            window = self.load_window(vidname, shard, img_name)
             if window is None:
                 continue
 
-            wrong_window = self.read_window(wrong_window_fnames)
+            wrong_window = self.load_window(vidname, shard, wrong_img_name)
             if wrong_window is None:
                 continue
 
             try:
-                wavpath = join(vidname, "audio.wav")
-                wav = audio.load_wav(wavpath, hparams.sample_rate)
-
-                orig_mel = audio.melspectrogram(wav).T
+                if shard is not None and shard.mel is not None:
+                    orig_mel = shard.mel
+                else:
+                    orig_mel = audio.load_mel(join(vidname, "audio.wav"))
             except Exception as e:
                 continue
 
-            mel = self.crop_audio_window(orig_mel.copy(), img_name)
+            mel = self.crop_audio_window(orig_mel, img_name)
             
             if (mel.shape[0] != syncnet_mel_step_size):
                 continue
 
-            indiv_mels = self.get_segmented_mels(orig_mel.copy(), img_name)
+            indiv_mels = self.get_segmented_mels(orig_mel, img_name)
             if indiv_mels is None: continue
 
             window = self.prepare_window(window)
@@ -181,10 +192,24 @@ def save_sample_images(x, g, gt, global_step, checkpoint_dir):
 logloss = nn.BCELoss()
 def cosine_loss(a, v, y):
     d = nn.functional.cosine_similarity(a, v)
-    loss = logloss(d.unsqueeze(1), y)
+    # BCE is not autocast safe, so it always runs in fp32
+    with torch.autocast(d.device.type, enabled=False):
+        loss = logloss(d.unsqueeze(1).float(), y)
 
     return loss
 
+def bce_loss(pred, target):
+    with torch.autocast(pred.device.type, enabled=False):
+        return F.binary_cross_entropy(pred.float(), torch.full((len(pred), 1), target, device=pred.device))
+
+def perceptual_loss_of(disc, g):
+    # what disc.perceptual_forward(g) computes, but through forward(), which torch.compile compiles
+    return bce_loss(disc(g), 1.)
+
+def running_value(loss):
+    # disabled losses are 0.
+    return loss.detach().float() if torch.is_tensor(loss) else torch.zeros((), device=device)
+
 device = torch.device("cuda" if use_cuda else "cpu")
 syncnet = SyncNet().to(device)
 for p in syncnet.parameters():
@@ -204,77 +229,78 @@ def train(device, model, disc, train_data_loader, test_data_loader, optimizer, d
     global global_step, global_epoch
     resumed_step = global_step
 
+    dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.precision]
+    if dtype == torch.float16 and device.type != 'cuda':
+        raise ValueError('fp16 training needs a GPU, use --precision bf16 on the CPU')
+    # fp16 gradients underflow without loss scaling; the scalers are no-ops otherwise
+    scaler = torch.amp.GradScaler('cuda', enabled=dtype == torch.float16)
+    disc_scaler = torch.amp.GradScaler('cuda', enabled=dtype == torch.float16)
+
+    # the compiled modules share their parameters with model and disc, which are saved as usual
+    train_model, train_disc = (torch.compile(model), torch.compile(disc)) if args.compile else (model, disc)
+
     while global_epoch < nepochs:
         print('Starting Epoch: {}'.format(global_epoch))
-        running_sync_loss, running_l1_loss, disc_loss, running_perceptual_loss = 0., 0., 0., 0.
-        running_disc_real_loss, running_disc_fake_loss = 0., 0.
+        # L1, sync, perceptual, disc fake, disc real; summed on the device
+        running_losses = torch.zeros(5, device=device)
+        log_time, log_step = time.time(), 0
         prog_bar = tqdm(enumerate(train_data_loader))
         for step, (x, indiv_mels, mel, gt) in prog_bar:
             disc.train()
             model.train()
 
-            x = x.to(device)
-            mel = mel.to(device)
-            indiv_mels = indiv_mels.to(device)
-            gt = gt.to(device)
+            x = x.to(device, non_blocking=True)
+            mel = mel.to(device, non_blocking=True)
+            indiv_mels = indiv_mels.to(device, non_blocking=True)
+            gt = gt.to(device, non_blocking=True)
 
             ### Train generator now. Remove ALL grads. 
             optimizer.zero_grad()
             disc_optimizer.zero_grad()
 
-            g = model(indiv_mels, x)
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype != torch.float32):
+                g = train_model(indiv_mels, x)
 
-            if hparams.syncnet_wt > 0.:
-                sync_loss = get_sync_loss(mel, g)
-            else:
-                sync_loss = 0.
+                if hparams.syncnet_wt > 0.:
+                    sync_loss = get_sync_loss(mel, g)
+                else:
+                    sync_loss = 0.
 
-            if hparams.disc_wt > 0.:
-                perceptual_loss = disc.perceptual_forward(g)
-            else:
-                perceptual_loss = 0.
+                if hparams.disc_wt > 0.:
+                    perceptual_loss = perceptual_loss_of(train_disc, g)
+                else:
+                    perceptual_loss = 0.
 
-            l1loss = recon_loss(g, gt)
+                l1loss = recon_loss(g, gt)
 
-            loss = hparams.syncnet_wt * sync_loss + hparams.disc_wt * perceptual_loss + \
-                                    (1. - hparams.syncnet_wt - hparams.disc_wt) * l1loss
+                loss = hparams.syncnet_wt * sync_loss + hparams.disc_wt * perceptual_loss + \
+                                        (1. - hparams.syncnet_wt - hparams.disc_wt) * l1loss
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             ### Remove all gradients before Training disc
             disc_optimizer.zero_grad()
 
-            pred = disc(gt)
-            disc_real_loss = F.binary_cross_entropy(pred, torch.ones((len(pred), 1)).to(device))
-            disc_real_loss.backward()
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype != torch.float32):
+                disc_real_loss = bce_loss(train_disc(gt), 1.)
+                disc_fake_loss = bce_loss(train_disc(g.detach()), 0.)
 
-            pred = disc(g.detach())
-            disc_fake_loss = F.binary_cross_entropy(pred, torch.zeros((len(pred), 1)).to(device))
-            disc_fake_loss.backward()
-
-            disc_optimizer.step()
-
-            running_disc_real_loss += disc_real_loss.item()
-            running_disc_fake_loss += disc_fake_loss.item()
+            disc_scaler.scale(disc_real_loss).backward()
+            disc_scaler.scale(disc_fake_loss).backward()
+            disc_scaler.step(disc_optimizer)
+            disc_scaler.update()
 
             if global_step % checkpoint_interval == 0:
-                save_sample_images(x, g, gt, global_step, checkpoint_dir)
+                save_sample_images(x, g.float(), gt, global_step, checkpoint_dir)
 
             # Logs
             global_step += 1
             cur_session_steps = global_step - resumed_step
 
-            running_l1_loss += l1loss.item()
-            if hparams.syncnet_wt > 0.:
-                running_sync_loss += sync_loss.item()
-            else:
-                running_sync_loss += 0.
-
-            if hparams.disc_wt > 0.:
-                running_perceptual_loss += perceptual_loss.item()
-            else:
-                running_perceptual_loss += 0.
+            running_losses += torch.stack([running_value(l1loss), running_value(sync_loss), running_value(perceptual_loss),
+                                           running_value(disc_fake_loss), running_value(disc_real_loss)])
 
             if global_step == 1 or global_step % checkpoint_interval == 0:
                 save_checkpoint(
@@ -289,11 +315,14 @@ def train(device, model, disc, train_data_loader, test_data_loader, optimizer, d
                     if average_sync_loss < .75:
                         hparams.set_hparam('syncnet_wt', 0.03)
 
-            prog_bar.set_description('L1: {}, Sync: {}, Percep: {} | Fake: {}, Real: {}'.format(running_l1_loss / (step + 1),
-                                                                                        running_sync_loss / (step + 1),
-                                                                                        running_perceptual_loss / (step + 1),
-                                                                                        running_disc_fake_loss / (step + 1),
-                                                                                        running_disc_real_loss / (step + 1)))
+            if (step + 1) % args.log_interval == 0:
+                l1, sync, perceptual, fake, real = (running_losses / (step + 1)).tolist()
+                now = time.time()
+                steps_per_sec = (step + 1 - log_step) / (now - log_time)
+                log_time, log_step = now, step + 1
+                prog_bar.set_description('L1: {}, Sync: {}, Percep: {} | Fake: {}, Real: {} | {:.2f} steps/s'.format(
+                                                                                        l1, sync, perceptual, fake, real,
+                                                                                        steps_per_sec))
 
         global_epoch += 1
 
@@ -324,7 +353,7 @@ def eval_model(test_data_loader, global_step, device, model, disc):
             sync_loss = get_sync_loss(mel, g)
             
             if hparams.disc_wt > 0.:
-                perceptual_loss = disc.perceptual_forward(g)
+                perceptual_loss = perceptual_loss_of(disc, g)
             else:
                 perceptual_loss = 0.
 
@@ -355,13 +384,12 @@ def save_checkpoint(model, optimizer, step, checkpoint_dir, epoch, prefix=''):
     checkpoint_path = join(
         checkpoint_dir, "{}checkpoint_step{:09d}.pth".format(prefix, global_step))
     optimizer_state = optimizer.state_dict() if hparams.save_optimizer_state else None
-    torch.save({
+    checkpoint_writer.save(checkpoint_path, {
         "state_dict": model.state_dict(),
         "optimizer": optimizer_state,
         "global_step": step,
         "global_epoch": epoch,
-    }, checkpoint_path)
-    print("Saved checkpoint:", checkpoint_path)
+    }, prefix=prefix + 'checkpoint_step')
 
 def _load(checkpoint_path):
     if use_cuda:
@@ -403,10 +431,11 @@ if __name__ == "__main__":
 
     train_data_loader = data_utils.DataLoader(
         train_dataset, batch_size=hparams.batch_size, shuffle=True,
-        num_workers=hparams.num_workers)
+        num_workers=hparams.num_workers, pin_memory=use_cuda)
 
+    # eval_model stops after eval_steps batches, shuffle so they cover all the val videos
     test_data_loader = data_utils.DataLoader(
-        test_dataset, batch_size=hparams.batch_size,
+        test_dataset, batch_size=hparams.batch_size, shuffle=True,
         num_workers=4)
 
     device = torch.device("cuda" if use_cuda else "cpu")
@@ -437,7 +466,17 @@ if __name__ == "__main__":
         os.mkdir(checkpoint_dir)
 
     # Train!
-    train(device, model, disc, train_data_loader, test_data_loader, optimizer, disc_optimizer,
-              checkpoint_dir=checkpoint_dir,
-              checkpoint_interval=hparams.checkpoint_interval,
-              nepochs=hparams.nepochs)
+    try:
+        train(device, model, disc, train_data_loader, test_data_loader, optimizer, disc_optimizer,
+                  checkpoint_dir=checkpoint_dir,
+                  checkpoint_interval=hparams.checkpoint_interval,
+                  nepochs=hparams.nepochs)
+    except:
+        # also on ctrl+c, so that queued checkpoints are not lost; a failed save must not
+        # hide the exception that stopped training
+        try:
+            checkpoint_writer.flush()
+        except Exception as e:
+            print('Could not save the queued checkpoints: {}'.format(e))
+        raise
+    checkpoint_writer.flush()
@@ -1,12 +1,26 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse, audio
-import json, subprocess, random, string
+import json, subprocess, random, string, copy
 from tqdm import tqdm
 from glob import glob
 import torch, face_detection
 from models import Wav2Lip
+from videoio import FFmpegWriter, read_frames
+import pipeline
+from batching import BatchBuilder, mel_windows
 import platform
+from collections import deque
+
+def str2bool(value):
+	if value.lower() in ('true', 'yes', '1'):
+		return True
+	if value.lower() in ('false', 'no', '0'):
+		return False
+	raise argparse.ArgumentTypeError('Expected a boolean, got {}'.format(value))
+
+# scratch files live in Wav2Lip/temp, wherever the script is run from (app/ runs it from the repo root)
+temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp')
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
@@ -20,8 +34,8 @@ parser.add_argument('--audio', type=str,
 parser.add_argument('--outfile', type=str, help='Video path to save result. See default for an e.g.', 
 								default='results/result_voice.mp4')
 
-parser.add_argument('--static', type=bool, 
-					help='If True, then use only first video frame for inference', default=False)
+parser.add_argument('--static', type=str2bool, nargs='?', const=True, 
+					help='If True, then use only first video frame for inference (a bare --static means True)', default=False)
 parser.add_argument('--fps', type=float, help='Can be specified only if input is a static image (default: 25)', 
 					default=25., required=False)
 
@@ -30,6 +44,13 @@ parser.add_argument('--pads', nargs='+', type=int, default=[0, 10, 0, 0],
 
 parser.add_argument('--face_det_batch_size', type=int, 
 					help='Batch size for face detection', default=16)
+parser.add_argument('--face_det_max_side', type=int, default=0,
+					help='Run face detection on a copy of each frame downscaled to this longer side (e.g. 480). '
+					'Boxes are mapped back to the full frame, so unlike --resize_factor the output keeps its resolution. '
+					'0 detects at full resolution')
+parser.add_argument('--face_det_nms_top_k', type=int, default=0,
+					help='Only the N highest scoring candidate boxes per frame go through NMS, which bounds its cost on busy '
+					'frames but can change the detected boxes when more candidates pass. 0 considers all of them')
 parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip model(s)', default=128)
 
 parser.add_argument('--resize_factor', default=1, type=int, 
@@ -50,11 +71,56 @@ parser.add_argument('--rotate', default=False, action='store_true',
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
 
-args = parser.parse_args()
-args.img_size = 96
-
-if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-	args.static = True
+parser.add_argument('--mel_backend', type=str, default='librosa', choices=['librosa', 'torch'],
+					help='Compute the mel spectrogram with librosa (float64) or in float32 torch on the inference device')
+
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+					help='Compute precision of the model. bf16 and fp16 are checked against fp32 on the first batch')
+parser.add_argument('--channels_last', default=False, action='store_true',
+					help='Run the model in channels-last memory format, usually faster on CPUs and tensor cores')
+parser.add_argument('--max_pixel_error', type=float, default=8.,
+					help='Largest difference in output pixel values (0-255) from fp32 tolerated for --precision/--channels_last')
+parser.add_argument('--nofuse', default=False, action='store_true',
+					help='Keep the BatchNorm layers separate instead of folding them into the convolutions')
+
+parser.add_argument('--face_det_cache_dir', type=str, default=os.path.join(temp_dir, 'face_det_cache'),
+					help='Directory caching face detections per avatar file. Empty string disables the cache')
+parser.add_argument('--face_det_cache_size', type=int, default=64,
+					help='Number of cached avatar detections to keep, least recently used ones are evicted')
+
+parser.add_argument('--track_interval', type=int, default=1,
+					help='Run the face detector only on every Nth frame (and on scene changes) and track the face '
+					'in between, falling back to detection when tracking is unsure. 1 detects every frame')
+parser.add_argument('--track_min_confidence', type=float, default=0.6,
+					help='Template match score below which a tracked frame is detected again')
+
+parser.add_argument('--stream', default=False, action='store_true',
+					help='Decode the face video lazily instead of loading every frame into memory. '
+					'Peak memory then depends on the batch sizes and not on the video length')
+
+parser.add_argument('--prefetch_batches', type=int, default=2,
+					help='Number of batches prepared (frames decoded, faces detected and cropped) ahead of the model')
+parser.add_argument('--paste_workers', type=int, default=4,
+					help='Threads pasting generated faces back into the frames while the model runs')
+
+parser.add_argument('--ffmpeg_path', type=str, default='ffmpeg',
+					help='ffmpeg executable used to convert the audio and encode the output video')
+parser.add_argument('--codec', type=str, default='libx264', help='ffmpeg video codec for the output video')
+parser.add_argument('--preset', type=str, default='medium',
+					help='Encoder speed/size preset (e.g. ultrafast ... veryslow for libx264). Empty string to omit')
+parser.add_argument('--crf', type=int, default=18, help='Constant rate factor of the output video (lower is better quality)')
+
+args = None
+
+def parse_args(argv=None):
+	global args
+	args = parser.parse_args(argv)
+	args.img_size = 96
+
+	if os.path.isfile(args.face) and args.face.split('.')[-1].lower() in ['jpg', 'png', 'jpeg']:
+		args.static = True
+
+	return args
 
 def get_smoothened_boxes(boxes, T):
 	for i in range(len(boxes)):
@@ -65,93 +131,206 @@ def get_smoothened_boxes(boxes, T):
 		boxes[i] = np.mean(window, axis=0)
 	return boxes
 
-def face_detect(images):
-	detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
+def stream_smoothened_boxes(items, T):
+	# Same boxes as get_smoothened_boxes, but over a stream of (frame, box) pairs
+	# holding at most T frames back. Boxes are only final once T - 1 later ones are known.
+	pending, emitted = deque(), deque(maxlen=T)
+	for frame, box in items:
+		pending.append((frame, box))
+		if len(pending) == T:
+			frame, box = pending.popleft()
+			box = np.mean([box] + [b for _, b in pending], axis=0).astype(box.dtype)
+			emitted.append(box)
+			yield frame, box
+
+	# The last frames average over the final T boxes, including the ones smoothed above
+	tail = list(emitted) + [b for _, b in pending]
+	for i in range(len(tail) - len(pending), len(tail)):
+		tail[i] = np.mean(tail[len(tail) - T:], axis=0).astype(tail[i].dtype)
+		yield pending.popleft()[0], tail[i]
+
+def padded_box(rect, image):
+	if rect is None:
+		cv2.imwrite(os.path.join(temp_dir, 'faulty_frame.jpg'), image) # check this frame where the face was not detected.
+		raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
+
+	pady1, pady2, padx1, padx2 = args.pads
+	y1 = max(0, rect[1] - pady1)
+	y2 = min(image.shape[0], rect[3] + pady2)
+	x1 = max(0, rect[0] - padx1)
+	x2 = min(image.shape[1], rect[2] + padx2)
+
+	return np.array([x1, y1, x2, y2])
+
+def load_detector():
+	return face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
 											flip_input=False, device=device)
 
-	batch_size = args.face_det_batch_size
-	
+class LazyDetector(object):
+	"""Builds the face detector on first use and keeps it, so that every pass over a looped video
+	shares one detector while runs answered from the detection cache never build it."""
+
+	def __init__(self):
+		self.detector = None
+
+	def get(self):
+		if self.detector is None:
+			self.detector = load_detector()
+		return self.detector
+
+def sequence_detector(detector=None):
+	# Detector for one pass over consecutive frames: a tracker around it when --track_interval > 1.
+	# A caller-supplied detector is kept alive; otherwise build one just for this pass
+	if detector is None:
+		detector = load_detector()
+	elif isinstance(detector, LazyDetector):
+		detector = detector.get()
+	# per run, the detector may be shared across jobs
+	detector.max_side = args.face_det_max_side
+	detector.nms_top_k = args.face_det_nms_top_k or None
+	if args.track_interval > 1:
+		detector = face_detection.FaceTracker(detector, args.track_interval, args.track_min_confidence)
+	return detector
+
+def report_tracking(detector):
+	if isinstance(detector, face_detection.FaceTracker):
+		print('Face detector ran on {} of {} frames'.format(detector.detected_frames,
+				detector.detected_frames + detector.tracked_frames))
+
+def detect_boxes(images, detector, progress=True):
+	# Padded, unsmoothed face boxes (x1, y1, x2, y2) of every image
+	# A tracker carries state across batches, rewind it when the images are detected again after an OOM
+	state = getattr(detector, 'state', None)
 	while 1:
+		batch_size = args.face_det_batch_size
 		predictions = []
+		if state is not None:
+			detector.state = state
 		try:
-			for i in tqdm(range(0, len(images), batch_size)):
+			for i in tqdm(range(0, len(images), batch_size), disable=not progress):
 				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
 		except RuntimeError:
 			if batch_size == 1: 
 				raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
-			batch_size //= 2
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
+			args.face_det_batch_size = batch_size // 2
+			print('Recovering from OOM error; New batch size: {}'.format(args.face_det_batch_size))
 			continue
 		break
 
-	results = []
-	pady1, pady2, padx1, padx2 = args.pads
-	for rect, image in zip(predictions, images):
-		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
-
-		y1 = max(0, rect[1] - pady1)
-		y2 = min(image.shape[0], rect[3] + pady2)
-		x1 = max(0, rect[0] - padx1)
-		x2 = min(image.shape[1], rect[2] + padx2)
-		
-		results.append([x1, y1, x2, y2])
-
-	boxes = np.array(results)
+	return np.array([padded_box(rect, image) for rect, image in zip(predictions, images)])
+
+face_cache = None
+
+def face_cache_key():
+	global face_cache
+	if not args.face_det_cache_dir:
+		return None
+	if face_cache is None or face_cache.cache_dir != args.face_det_cache_dir:
+		face_cache = face_detection.BoxCache(args.face_det_cache_dir, args.face_det_cache_size)
+	face_cache.max_entries = args.face_det_cache_size
+
+	# Everything that changes the frames handed to the detector, or the boxes it returns
+	return face_cache.key(args.face, pads=args.pads, resize_factor=args.resize_factor,
+							crop=args.crop, rotate=args.rotate, max_side=args.face_det_max_side,
+							nms_top_k=args.face_det_nms_top_k, track_interval=args.track_interval, track_min_confidence=args.track_min_confidence)
+
+def load_cached_boxes(num_frames):
+	key = face_cache_key()
+	if key is None:
+		return None
+	boxes = face_cache.load(key, num_frames)
+	if boxes is not None:
+		print('Using cached face detections for {}'.format(args.face))
+	return boxes
+
+def save_cached_boxes(boxes, complete):
+	# complete: boxes cover every frame of the video, not just the first len(boxes)
+	key = face_cache_key()
+	if key is not None:
+		face_cache.save(key, boxes, complete)
+
+def face_detect(images, detector=None, complete=False):
+	boxes = load_cached_boxes(len(images))
+	if boxes is None:
+		detector = sequence_detector(detector)
+		boxes = detect_boxes(images, detector)
+		report_tracking(detector)
+		save_cached_boxes(boxes, complete)
+
 	if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
 	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
-	del detector
 	return results 
 
-def datagen(frames, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
+def stream_face_detect(frames, num_frames, detector=None):
+	# Detects faces over a stream of at most num_frames frames, face_det_batch_size frames at a time
+	def boxes():
+		tracker = sequence_detector(detector)
+		images, all_boxes = [], []
+		for frame in frames:
+			images.append(frame)
+			if len(images) == args.face_det_batch_size:
+				boxes = detect_boxes(images, tracker, progress=False)
+				all_boxes.extend(boxes)
+				yield from zip(images, boxes)
+				images = []
+		if len(images) > 0:
+			boxes = detect_boxes(images, tracker, progress=False)
+			all_boxes.extend(boxes)
+			yield from zip(images, boxes)
+
+		report_tracking(tracker)
+		save_cached_boxes(all_boxes, complete=len(all_boxes) < num_frames)
+
+	cached_boxes = load_cached_boxes(num_frames)
+	results = boxes() if cached_boxes is None else zip(frames, cached_boxes)
+
+	if not args.nosmooth: results = stream_smoothened_boxes(results, T=5)
+	for image, (x1, y1, x2, y2) in results:
+		yield image, (y1, y2, x1, x2)
+
+def loaded_frame_faces(frames, num_frames, detector=None):
+	# Yields (frame, face coords) for each of num_frames output frames, looping over the loaded frames
 	if args.box[0] == -1:
 		if not args.static:
-			face_det_results = face_detect(frames) # BGR2RGB for CNN face detection
+			# frames shorter than num_frames means they hold the whole video
+			face_det_results = face_detect(frames, detector, complete=len(frames) < num_frames) # BGR2RGB for CNN face detection
 		else:
-			face_det_results = face_detect([frames[0]])
+			face_det_results = face_detect([frames[0]], detector)
 	else:
 		print('Using the specified bounding box instead of face detection...')
 		y1, y2, x1, x2 = args.box
 		face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
 
-	for i, m in enumerate(mels):
+	for i in range(num_frames):
 		idx = 0 if args.static else i%len(frames)
-		frame_to_save = frames[idx].copy()
-		face, coords = face_det_results[idx].copy()
-
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
-
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
-
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
+		yield frames[idx].copy(), face_det_results[idx][1]
+
+def streamed_frame_faces(num_frames, detector=None):
+	# Same as loaded_frame_faces but decodes the video lazily. When the video is shorter than
+	# the audio it is decoded (and its faces detected) again from the start, as the in-memory loop would.
+	count = 0
+	while count < num_frames:
+		frames = read_frames(args.face, args.resize_factor, args.rotate, args.crop, limit=num_frames)
+		if args.box[0] == -1:
+			frame_faces = stream_face_detect(frames, num_frames, detector)
+		else:
+			y1, y2, x1, x2 = args.box
+			frame_faces = ((f, (y1, y2, x1, x2)) for f in frames)
 
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+		start = count
+		for frame, coords in frame_faces:
+			if count == num_frames:
+				break
+			yield frame, coords
+			count += 1
+		if count == start:
+			raise ValueError('Could not read any frames from {}'.format(args.face))
 
-		yield img_batch, mel_batch, frame_batch, coords_batch
+def datagen(frame_faces, mels, builder):
+	# uint8 face and float32 mel batches, see BatchBuilder
+	items = ((frame[y1: y2, x1:x2], i, frame, (y1, y2, x1, x2)) for i, (frame, (y1, y2, x1, x2)) in enumerate(frame_faces))
+	return builder.batches(items, mels)
 
 mel_step_size = 16
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -165,7 +344,7 @@ def _load(checkpoint_path):
 								map_location=lambda storage, loc: storage)
 	return checkpoint
 
-def load_model(path):
+def load_model(path, fuse=True):
 	model = Wav2Lip()
 	print("Load checkpoint from: {}".format(path))
 	checkpoint = _load(path)
@@ -175,10 +354,48 @@ def load_model(path):
 		new_s[k.replace('module.', '')] = v
 	model.load_state_dict(new_s)
 
-	model = model.to(device)
-	return model.eval()
-
-def main():
+	model = model.to(device).eval()
+	if fuse:
+		model.fuse_for_inference()
+	return model
+
+precisions = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+# (precision, channels_last) -> (fp32 model, its converted copy), so that repeated main() calls
+# with the same preloaded model (lipsync_server) convert it only once
+prepared_models = {}
+
+def prepare_model(model):
+	# The fp32 model itself, or a copy in the requested precision and memory format
+	if args.precision == 'fp32' and not args.channels_last:
+		return model
+	if args.precision == 'fp16' and device == 'cpu':
+		raise ValueError('--precision fp16 needs a CUDA device, use bf16 on CPU')
+
+	key = (args.precision, args.channels_last)
+	if key in prepared_models and prepared_models[key][0] is model:
+		return prepared_models[key][1]
+
+	memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+	prepared = copy.deepcopy(model).to(dtype=precisions[args.precision], memory_format=memory_format)
+	prepared_models[key] = (model, prepared)
+	return prepared
+
+def model_input(x):
+	memory_format = torch.channels_last if args.channels_last else torch.preserve_format
+	return x.to(dtype=precisions[args.precision], memory_format=memory_format)
+
+def check_precision(reference, mel_batch, faces, pred):
+	# Compares a batch rendered with prepare_model() to the fp32 reference model, in output pixel values
+	with torch.no_grad():
+		error = (pred.float() - reference(mel_batch, faces)).abs().max().item() * 255.
+	print('Max pixel error of {}{} against fp32: {:.2f}'.format(args.precision,
+			' channels_last' if args.channels_last else '', error))
+	if error > args.max_pixel_error:
+		raise ValueError('Output deviates from fp32 by {:.2f} pixel values (--max_pixel_error {}). '
+						'Use --precision fp32'.format(error, args.max_pixel_error))
+
+def main(model=None, detector=None):
 	if not os.path.isfile(args.face):
 		raise ValueError('--face argument must be a valid path to video/image file')
 
@@ -196,97 +413,118 @@ def main():
 	else:
 		video_stream = cv2.VideoCapture(args.face)
 		fps = video_stream.get(cv2.CAP_PROP_FPS)
+		video_stream.release()
 
-		print('Reading video frames...')
-
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading:
-				video_stream.release()
-				break
-			if args.resize_factor > 1:
-				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-
-			if args.rotate:
-				frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-
-			y1, y2, x1, x2 = args.crop
-			if x2 == -1: x2 = frame.shape[1]
-			if y2 == -1: y2 = frame.shape[0]
-
-			frame = frame[y1:y2, x1:x2]
-
-			full_frames.append(frame)
+		if args.stream and not args.static:
+			full_frames = None
+		else:
+			print('Reading video frames...')
+			full_frames = list(read_frames(args.face, args.resize_factor, args.rotate, args.crop))
 
-	print ("Number of frames available for inference: "+str(len(full_frames)))
+	if full_frames is not None:
+		print ("Number of frames available for inference: "+str(len(full_frames)))
 
 	if not args.audio.endswith('.wav'):
 		print("Converting input audio to wav...")
-		ffmpeg_path = r"C:\Users\Aaryan\ffmpeg-2025-08-18-git-0226b6fb2c-essentials_build\ffmpeg-2025-08-18-git-0226b6fb2c-essentials_build\bin\ffmpeg.exe"
-		wav_audio = r"C:\Users\Aaryan\ai-pdf-to-video\Wav2Lip\temp\temp.wav"
-		command = f'"{ffmpeg_path}" -y -i "{args.audio}" -ar 16000 -ac 1 "{wav_audio}"'
+		wav_audio = os.path.join(temp_dir, 'temp.wav')
+		command = f'"{args.ffmpeg_path}" -y -i "{args.audio}" -ar 16000 -ac 1 "{wav_audio}"'
 		subprocess.call(command, shell=True)
 		args.audio = wav_audio
 
 	wav = audio.load_wav(args.audio, 16000)
-	mel = audio.melspectrogram(wav)
+	if args.mel_backend == 'torch':
+		mel = audio.melspectrogram_torch(wav, device).cpu().numpy()
+	else:
+		mel = audio.melspectrogram(wav)
 	print(mel.shape)
 
 	if np.isnan(mel.reshape(-1)).sum() > 0:
 		raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
 
-	mel_chunks = []
-	mel_idx_multiplier = 80./fps 
-	i = 0
-	while 1:
-		start_idx = int(i * mel_idx_multiplier)
-		if start_idx + mel_step_size > len(mel[0]):
-			mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-			break
-		mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-		i += 1
+	mel_chunks = mel_windows(mel, fps, mel_step_size)
 
 	print("Length of mel chunks: {}".format(len(mel_chunks)))
 
-	full_frames = full_frames[:len(mel_chunks)]
+	if detector is None:
+		detector = LazyDetector()
 
-	batch_size = args.wav2lip_batch_size
-	gen = datagen(full_frames.copy(), mel_chunks)
-
-	for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
-											total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
-		if i == 0:
-			model = load_model(args.checkpoint_path)
-			print ("Model loaded")
-
-			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter(r"C:\Users\Aaryan\ai-pdf-to-video\Wav2Lip\temp\result.avi",
-                    cv2.VideoWriter_fourcc(*'DIVX'),
-                    fps, (frame_w, frame_h))
-
-
-		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-		with torch.no_grad():
-			pred = model(mel_batch, img_batch)
-
-		pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-		
-		for p, f, c in zip(pred, frames, coords):
-			y1, y2, x1, x2 = c
-			p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-
-			f[y1:y2, x1:x2] = p
-			out.write(f)
-
-	out.release()
+	if full_frames is None:
+		frame_faces = streamed_frame_faces(len(mel_chunks), detector)
+	else:
+		full_frames = full_frames[:len(mel_chunks)]
+		frame_faces = loaded_frame_faces(full_frames.copy(), len(mel_chunks), detector)
 
-	ffmpeg_path = r"C:\Users\Aaryan\ffmpeg-2025-08-18-git-0226b6fb2c-essentials_build\ffmpeg-2025-08-18-git-0226b6fb2c-essentials_build\bin\ffmpeg.exe"
-	result_path = r"C:\Users\Aaryan\ai-pdf-to-video\Wav2Lip\temp\result.avi"
-	command = f'"{ffmpeg_path}" -y -i "{args.audio}" -i "{result_path}" -strict -2 -q:v 1 "{args.outfile}"'
-	subprocess.call(command, shell=True)
+	batch_size = args.wav2lip_batch_size
+	timer = pipeline.StageTimer()
+	# a batch is in use until the model is done with it, behind prefetch_batches queued ones and the one being built
+	builder = BatchBuilder(batch_size, args.img_size, num_buffers=args.prefetch_batches + 2)
+	gen = pipeline.prefetch(timer.iterate(datagen(frame_faces, mel_chunks, builder), 'prepare'), args.prefetch_batches)
+
+	def paste(pred, frames, coords):
+		with timer.time('paste', len(frames)):
+			for p, f, c in zip(pred, frames, coords):
+				y1, y2, x1, x2 = c
+				p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+
+				f[y1:y2, x1:x2] = p
+		return frames
+
+	def write(frames):
+		with timer.time('write', len(frames)):
+			for f in frames:
+				out.write(f)
+
+	out = workers = None
+	try:
+		for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
+												total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
+			if i == 0:
+				if model is None:
+					model = load_model(args.checkpoint_path, fuse=not args.nofuse)
+					print ("Model loaded")
+				reference, model = model, prepare_model(model)
+
+				frame_h, frame_w = frames[0].shape[:-1]
+				out = FFmpegWriter(args.outfile, fps, (frame_w, frame_h), audio=args.audio,
+									codec=args.codec, preset=args.preset, crf=args.crf, ffmpeg_path=args.ffmpeg_path)
+				workers = pipeline.OrderedWorkers(paste, write, args.paste_workers, max_pending=2 * args.paste_workers)
+
+			with timer.time('h2d'):
+				mel_batch = pipeline.to_device(mel_batch, device).permute(0, 3, 1, 2)
+				if not args.static or i == 0:
+					faces = builder.face_input(pipeline.to_device(img_batch[:1] if args.static else img_batch, device))
+
+			with timer.time('model'), torch.no_grad():
+				if args.static:
+					# Every frame shares the same masked + reference face, so the face
+					# encoder only has to run once; later batches reuse its features.
+					if i == 0:
+						face_feats = model.encode_face(model_input(faces))
+					pred = model.decode(model_input(mel_batch), face_feats)
+				else:
+					pred = model(model_input(mel_batch), model_input(faces))
+
+				if i == 0 and model is not reference:
+					check_precision(reference, mel_batch, faces, pred)
+				pred = pred.float().cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+			workers.submit(pred, frames, coords)
+
+		workers.close()
+		out.close()
+	except:
+		# drop the queued frames and the partial outfile, so that no ffmpeg process or
+		# worker thread outlives a failed job (lipsync_server runs many in one process)
+		if workers is not None:
+			workers.abort()
+		if out is not None:
+			out.abort()
+		raise
+	finally:
+		gen.close()
+
+	print(timer.report())
 
 if __name__ == '__main__':
+	parse_args()
 	main()
@@ -0,0 +1,120 @@
+"""Long-lived lip-sync engine.
+
+Keeps the Wav2Lip model and the S3FD face detector loaded so that repeated jobs
+skip the torch import, checkpoint load and detector construction that every
+`python inference.py` invocation pays for.
+
+Use it in-process:
+
+	from lipsync_server import LipSyncEngine
+	engine = LipSyncEngine('checkpoints/wav2lip.pth')
+	engine.run('face.jpg', 'speech.wav', 'results/out.mp4')
+
+or as a local HTTP daemon:
+
+	python lipsync_server.py --checkpoint_path checkpoints/wav2lip.pth --port 8765
+
+which accepts `POST /jobs` with a JSON body of the form
+{"face": ..., "audio": ..., "outfile": ..., "options": {"pads": [0, 10, 0, 0]}}.
+Options are any of the `inference.py` arguments. Relative paths resolve against
+the daemon's working directory, so clients should send absolute paths.
+"""
+import argparse, json, os, threading, time, traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import inference
+import pipeline
+
+class LipSyncEngine(object):
+	def __init__(self, checkpoint_path, **defaults):
+		self.checkpoint_path = checkpoint_path
+		self.defaults = defaults
+
+		self.model = inference.load_model(checkpoint_path)
+		self.detector = inference.load_detector()
+
+		# inference.py keeps its options in a module level namespace, so jobs run one at a time
+		self.lock = threading.Lock()
+
+	def run(self, face, audio, outfile, **options):
+		argv = ['--checkpoint_path', self.checkpoint_path, '--face', face,
+				'--audio', audio, '--outfile', outfile]
+
+		with self.lock:
+			args = inference.parse_args(argv)
+			for key, value in dict(self.defaults, **options).items():
+				if not hasattr(args, key):
+					raise ValueError('Unknown inference option: {}'.format(key))
+				setattr(args, key, value)
+
+			try:
+				inference.main(model=self.model, detector=self.detector)
+			except:
+				self._check_cleanup(outfile)
+				raise
+
+		return outfile
+
+	def _check_cleanup(self, outfile):
+		# a failed job must not leave anything behind in the daemon, see the cleanup in inference.main
+		leaked = pipeline.live_threads()
+		if len(leaked) > 0:
+			print('Warning: the failed job left {} pipeline threads running'.format(len(leaked)))
+		if os.path.exists(outfile):
+			print('Warning: the failed job left a partial {}'.format(outfile))
+
+class JobHandler(BaseHTTPRequestHandler):
+	engine = None
+
+	def _reply(self, code, body):
+		data = json.dumps(body).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		if self.path != '/health':
+			return self._reply(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+		self._reply(200, {'status': 'ok', 'checkpoint_path': self.engine.checkpoint_path})
+
+	def do_POST(self):
+		if self.path != '/jobs':
+			return self._reply(404, {'error': 'Unknown endpoint {}'.format(self.path)})
+
+		try:
+			job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			face, audio, outfile = job['face'], job['audio'], job['outfile']
+		except (ValueError, KeyError, TypeError) as e:
+			return self._reply(400, {'error': 'Bad job request: {}'.format(e)})
+
+		start = time.time()
+		try:
+			self.engine.run(face, audio, outfile, **job.get('options', {}))
+		except Exception as e:
+			traceback.print_exc()
+			return self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+		self._reply(200, {'outfile': outfile, 'seconds': time.time() - start})
+
+def serve(engine, host='127.0.0.1', port=8765):
+	JobHandler.engine = engine
+	server = ThreadingHTTPServer((host, port), JobHandler)
+	print('Lip-sync server listening on http://{}:{}'.format(host, port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+if __name__ == '__main__':
+	server_parser = argparse.ArgumentParser(description='Persistent Wav2Lip lip-sync server')
+	server_parser.add_argument('--checkpoint_path', type=str,
+						help='Name of saved checkpoint to load weights from', required=True)
+	server_parser.add_argument('--host', type=str, default='127.0.0.1')
+	server_parser.add_argument('--port', type=int, default=8765)
+	server_args = server_parser.parse_args()
+
+	serve(LipSyncEngine(server_args.checkpoint_path), server_args.host, server_args.port)
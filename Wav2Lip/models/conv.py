@@ -1,7 +1,23 @@
+import copy
 import torch
 from torch import nn
 from torch.nn import functional as F
 
+def fuse_conv_bn(conv, bn):
+    """Returns a copy of `conv` with the eval-mode affine of the following `bn` folded in."""
+    fused = copy.deepcopy(conv)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+    # output channels are dim 0 of a Conv2d weight but dim 1 of a ConvTranspose2d weight
+    shape = [1] * conv.weight.dim()
+    shape[1 if isinstance(conv, nn.ConvTranspose2d) else 0] = -1
+
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight * scale.view(shape))
+        fused.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
 class Conv2d(nn.Module):
     def __init__(self, cin, cout, kernel_size, stride, padding, residual=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -12,6 +28,11 @@ class Conv2d(nn.Module):
         self.act = nn.ReLU()
         self.residual = residual
 
+    def fuse(self):
+        # inference only: replaces the conv + BatchNorm block by a single conv
+        if isinstance(self.conv_block, nn.Sequential):
+            self.conv_block = fuse_conv_bn(*self.conv_block)
+
     def forward(self, x):
         out = self.conv_block(x)
         if self.residual:
@@ -39,6 +60,11 @@ class Conv2dTranspose(nn.Module):
                             )
         self.act = nn.ReLU()
 
+    def fuse(self):
+        # inference only: replaces the transposed conv + BatchNorm block by a single transposed conv
+        if isinstance(self.conv_block, nn.Sequential):
+            self.conv_block = fuse_conv_bn(*self.conv_block)
+
     def forward(self, x):
         out = self.conv_block(x)
         return self.act(out)
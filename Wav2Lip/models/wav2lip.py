@@ -2,6 +2,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 import math
+import copy
 
 from .conv import Conv2dTranspose, Conv2d, nonorm_Conv2d
 
@@ -84,36 +85,44 @@ class Wav2Lip(nn.Module):
             nn.Conv2d(32, 3, kernel_size=1, stride=1, padding=0),
             nn.Sigmoid()) 
 
-    def forward(self, audio_sequences, face_sequences):
-        # audio_sequences = (B, T, 1, 80, 16)
-        B = audio_sequences.size(0)
-
-        input_dim_size = len(face_sequences.size())
-        if input_dim_size > 4:
-            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
-            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
-
-        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
-
+    def encode_face(self, face_sequences):
+        # face_sequences = (B, 6, H, W); returns the skip-connection features
         feats = []
         x = face_sequences
         for f in self.face_encoder_blocks:
             x = f(x)
             feats.append(x)
 
+        return feats
+
+    def decode(self, audio_sequences, feats):
+        # feats may hold a single face (batch of 1), which is broadcast over the audio batch
+        audio_embedding = self.audio_encoder(audio_sequences) # B, 512, 1, 1
+
         x = audio_embedding
-        for f in self.face_decoder_blocks:
+        for f, feat in zip(self.face_decoder_blocks, reversed(feats)):
             x = f(x)
+            if feat.size(0) != x.size(0):
+                feat = feat.expand(x.size(0), -1, -1, -1)
             try:
-                x = torch.cat((x, feats[-1]), dim=1)
+                x = torch.cat((x, feat), dim=1)
             except Exception as e:
                 print(x.size())
-                print(feats[-1].size())
+                print(feat.size())
                 raise e
-            
-            feats.pop()
 
-        x = self.output_block(x)
+        return self.output_block(x)
+
+    def forward(self, audio_sequences, face_sequences):
+        # audio_sequences = (B, T, 1, 80, 16)
+        B = audio_sequences.size(0)
+
+        input_dim_size = len(face_sequences.size())
+        if input_dim_size > 4:
+            audio_sequences = torch.cat([audio_sequences[:, i] for i in range(audio_sequences.size(1))], dim=0)
+            face_sequences = torch.cat([face_sequences[:, :, i] for i in range(face_sequences.size(2))], dim=0)
+
+        x = self.decode(audio_sequences, self.encode_face(face_sequences))
 
         if input_dim_size > 4:
             x = torch.split(x, B, dim=0) # [(B, C, H, W)]
@@ -124,6 +133,49 @@ class Wav2Lip(nn.Module):
             
         return outputs
 
+    def fuse_for_inference(self, check=True, max_pixel_error=0.5):
+        """Folds every BatchNorm into its convolution and unwraps single-layer blocks, in place.
+
+        The fused model is inference only (it can no longer be trained or load checkpoints).
+        With `check`, it is compared against the unfused one on fixed random inputs in strict
+        fp32, and a warning is printed if any output differs by more than `max_pixel_error`
+        pixel values.
+        """
+        self.eval()
+        reference = copy.deepcopy(self) if check else None
+
+        for m in self.modules():
+            if isinstance(m, (Conv2d, Conv2dTranspose)):
+                m.fuse()
+
+        for blocks in (self.face_encoder_blocks, self.face_decoder_blocks):
+            for i, block in enumerate(blocks):
+                if isinstance(block, nn.Sequential) and len(block) == 1:
+                    blocks[i] = block[0]
+
+        if check:
+            error = fusion_error(self, reference) * 255.
+            if error > max_pixel_error:
+                print('Warning: the fused model deviates from the original by {:.2f} pixel values '
+                      '(max {}), consider --nofuse'.format(error, max_pixel_error))
+
+        return self
+
+def fusion_error(fused, reference):
+    # max output difference on fixed inputs, with TF32 off so that only the fusion itself is measured
+    param = next(fused.parameters())
+    generator = torch.Generator().manual_seed(0)
+    audio = torch.randn(4, 1, 80, 16, generator=generator).to(param.device, param.dtype)
+    face = torch.rand(4, 6, 96, 96, generator=generator).to(param.device, param.dtype)
+
+    tf32 = torch.backends.cudnn.allow_tf32, torch.backends.cuda.matmul.allow_tf32
+    torch.backends.cudnn.allow_tf32 = torch.backends.cuda.matmul.allow_tf32 = False
+    try:
+        with torch.no_grad():
+            return (fused(audio, face) - reference(audio, face)).abs().max().item()
+    finally:
+        torch.backends.cudnn.allow_tf32, torch.backends.cuda.matmul.allow_tf32 = tf32
+
 class Wav2Lip_disc_qual(nn.Module):
     def __init__(self):
         super(Wav2Lip_disc_qual, self).__init__()
@@ -168,8 +220,11 @@ class Wav2Lip_disc_qual(nn.Module):
         for f in self.face_encoder_blocks:
             false_feats = f(false_feats)
 
-        false_pred_loss = F.binary_cross_entropy(self.binary_pred(false_feats).view(len(false_feats), -1), 
-                                        torch.ones((len(false_feats), 1)).cuda())
+        false_pred = self.binary_pred(false_feats).view(len(false_feats), -1)
+        # binary_cross_entropy is not autocast safe, so it always runs in fp32
+        with torch.autocast(false_pred.device.type, enabled=False):
+            false_pred_loss = F.binary_cross_entropy(false_pred.float(),
+                                        torch.ones((len(false_feats), 1), device=false_pred.device))
 
         return false_pred_loss
 
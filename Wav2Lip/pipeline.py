@@ -0,0 +1,154 @@
+import threading, time, queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import torch
+
+class StageTimer(object):
+	"""Accumulates the busy time and item count of named pipeline stages.
+
+	Stages run in different threads and overlap, so the stage with the largest
+	busy time, not the sum of all of them, bounds the throughput.
+	"""
+
+	def __init__(self):
+		self.seconds = OrderedDict()
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+		self.start = time.time()
+
+	def add(self, stage, seconds, items=1):
+		with self.lock:
+			self.seconds[stage] = self.seconds.get(stage, 0.) + seconds
+			self.items[stage] = self.items.get(stage, 0) + items
+
+	@contextmanager
+	def time(self, stage, items=1):
+		start = time.time()
+		yield
+		self.add(stage, time.time() - start, items)
+
+	def iterate(self, iterable, stage):
+		# times every next() on iterable
+		iterator = iter(iterable)
+		while 1:
+			start = time.time()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			self.add(stage, time.time() - start)
+			yield item
+
+	def report(self):
+		wall = time.time() - self.start
+		lines = ['Stage timings over {:.2f}s wall time (stages overlap):'.format(wall)]
+		for stage, seconds in self.seconds.items():
+			lines.append('  {:<10s} {:8.2f}s busy {:5.1f}%  {:6d} items'.format(stage, seconds,
+							100. * seconds / max(wall, 1e-9), self.items[stage]))
+		return '\n'.join(lines)
+
+def prefetch(iterable, depth=2):
+	"""Runs iterable in a background thread, keeping up to `depth` items ready.
+
+	Exceptions raised by the producer are re-raised in the consumer. Closing the
+	generator stops the producer thread and waits for it to exit.
+	"""
+	items = queue.Queue(maxsize=depth)
+	stop = threading.Event()
+	done = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				items.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return
+		except BaseException as e:
+			put((done, e))
+			return
+		put((done, None))
+
+	thread = threading.Thread(target=produce, name='pipeline-prefetch', daemon=True)
+	thread.start()
+	try:
+		while 1:
+			item, error = items.get()
+			if item is done:
+				if error is not None:
+					raise error
+				return
+			yield item
+	finally:
+		stop.set()
+		# the producer notices within its put() timeout, or after the item it is making
+		thread.join()
+
+def live_threads():
+	"""The threads of prefetch() and OrderedWorkers still running, e.g. to check nothing outlived a job."""
+	return [thread for thread in threading.enumerate() if thread.name.startswith('pipeline-')]
+
+def to_device(array, device):
+	"""numpy array -> tensor on device; host to GPU copies go through pinned memory asynchronously."""
+	tensor = torch.from_numpy(array)
+	if torch.device(device).type == 'cuda':
+		return tensor.pin_memory().to(device, non_blocking=True)
+	return tensor.to(device)
+
+class OrderedWorkers(object):
+	"""Runs `work(*args)` on a thread pool and hands the results to `consume` in submission order.
+
+	`consume` runs on its own thread, so e.g. pasting frames and piping them to the
+	encoder overlap with the caller. At most `max_pending` jobs are in flight; submit()
+	blocks beyond that. Errors from either side are re-raised by submit() or close().
+	"""
+
+	def __init__(self, work, consume, workers=4, max_pending=8):
+		self.work, self.consume = work, consume
+		self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline-work')
+		self.pending = queue.Queue(maxsize=max_pending)
+		self.error = None
+		self.aborted = False
+		self.thread = threading.Thread(target=self._drain, name='pipeline-consume', daemon=True)
+		self.thread.start()
+
+	def _drain(self):
+		while 1:
+			future = self.pending.get()
+			if future is None:
+				return
+			if self.error is not None or self.aborted:
+				continue # keep draining so submit() never blocks on a dead consumer
+			try:
+				self.consume(future.result())
+			except BaseException as e:
+				self.error = e
+
+	def _check(self):
+		if self.error is not None:
+			raise self.error
+
+	def submit(self, *args):
+		self._check()
+		self.pending.put(self.pool.submit(self.work, *args))
+
+	def close(self):
+		self.pending.put(None)
+		self.thread.join()
+		self.pool.shutdown()
+		self._check()
+
+	def abort(self):
+		"""Stops without consuming the pending results and without raising errors, e.g. after a failure."""
+		self.aborted = True
+		self.pending.put(None)
+		self.thread.join()
+		self.pool.shutdown()
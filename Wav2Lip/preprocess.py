@@ -10,12 +10,15 @@ if not path.isfile('face_detection/detection/sfd/s3fd.pth'):
 							before running this script!')
 
 import multiprocessing as mp
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import argparse, os, cv2, traceback, subprocess
+import argparse, os, cv2, traceback, subprocess, json, time
 from tqdm import tqdm
 from glob import glob
+import torch
 import audio
+import pipeline
+from shards import ShardWriter, shard_path
 from hparams import hparams as hp
 
 import face_detection
@@ -23,91 +26,180 @@ import face_detection
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--ngpu', help='Number of GPUs across which to run in parallel', default=1, type=int)
+parser.add_argument('--workers_per_gpu', help='Worker processes per GPU (or in total when running on CPU)', default=1, type=int)
 parser.add_argument('--batch_size', help='Single GPU Face detection batch size', default=32, type=int)
+parser.add_argument('--nms_top_k', help='Candidate boxes per frame considered by the face detector NMS, bounds its cost '
+					'on busy frames but can change the detections. 0 considers all of them', default=0, type=int)
 parser.add_argument("--data_root", help="Root folder of the LRS2 dataset", required=True)
 parser.add_argument("--preprocessed_root", help="Root folder of the preprocessed dataset", required=True)
+parser.add_argument('--format', help='jpg: a folder of face crops per video, shard: one file of resized crops and the mel per video',
+					default='jpg', choices=['jpg', 'shard'])
+parser.add_argument('--write_threads', help='Threads writing face crops in each worker', default=4, type=int)
+parser.add_argument('--manifest', help='JSONL record of processed videos, finished ones are skipped when rerunning. '
+					'Defaults to manifest.jsonl in preprocessed_root', default=None)
 
-args = parser.parse_args()
+template = ['ffmpeg', '-loglevel', 'panic', '-y', '-i', '{vfile}', '-strict', '-2', '{wavpath}']
+# template2 = 'ffmpeg -hide_banner -loglevel panic -threads 1 -y -i {} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {}'
 
-fa = [face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, 
-									device='cuda:{}'.format(id)) for id in range(args.ngpu)]
+fa = None # face detector of this worker process
 
-template = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'
-# template2 = 'ffmpeg -hide_banner -loglevel panic -threads 1 -y -i {} -async 1 -ac 1 -vn -acodec pcm_s16le -ar 16000 {}'
+def init_worker(devices, nms_top_k):
+	global fa
+	fa = face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, device=devices.get(),
+									nms_top_k=nms_top_k or None)
 
-def process_video_file(vfile, args, gpu_id):
+def output_dir(vfile, args):
+	vidname = os.path.basename(vfile).split('.')[0]
+	dirname = vfile.split('/')[-2]
+
+	fulldir = path.join(args.preprocessed_root, dirname, vidname)
+	os.makedirs(fulldir, exist_ok=True)
+	return fulldir
+
+def read_frames(vfile, batch_size):
 	video_stream = cv2.VideoCapture(vfile)
-	
-	frames = []
+	batch = []
 	while 1:
 		still_reading, frame = video_stream.read()
 		if not still_reading:
 			video_stream.release()
 			break
-		frames.append(frame)
-	
-	vidname = os.path.basename(vfile).split('.')[0]
-	dirname = vfile.split('/')[-2]
+		batch.append(frame)
+		if len(batch) == batch_size:
+			yield batch
+			batch = []
 
-	fulldir = path.join(args.preprocessed_root, dirname, vidname)
-	os.makedirs(fulldir, exist_ok=True)
+	if len(batch) > 0:
+		yield batch
+
+def process_video_file(vfile, args, wavpath=None):
+	"""Detects and saves the faces of vfile, decoding, detecting and writing concurrently.
 
-	batches = [frames[i:i + args.batch_size] for i in range(0, len(frames), args.batch_size)]
+	wavpath is a future of the extracted audio, whose mel goes into a shard. Returns (frames, faces).
+	"""
+	fulldir = output_dir(vfile, args)
 
-	i = -1
-	for fb in batches:
-		preds = fa[gpu_id].get_detections_for_batch(np.asarray(fb))
+	writer = None
+	if args.format == 'shard':
+		writer = ShardWriter(shard_path(fulldir), hp.img_size)
 
+	def crop(fb, preds, start):
+		faces = []
 		for j, f in enumerate(preds):
-			i += 1
 			if f is None:
 				continue
 
 			x1, y1, x2, y2 = f
-			cv2.imwrite(path.join(fulldir, '{}.jpg'.format(i)), fb[j][y1:y2, x1:x2])
+			if writer is None:
+				cv2.imwrite(path.join(fulldir, '{}.jpg'.format(start + j)), fb[j][y1:y2, x1:x2])
+			faces.append((start + j, fb[j][y1:y2, x1:x2]))
+		return faces
+
+	num_faces = [0]
+	def save(faces):
+		num_faces[0] += len(faces)
+		if writer is not None:
+			for i, face in faces: # in frame order, batches are consumed in submission order
+				writer.add(i, face)
+
+	workers = pipeline.OrderedWorkers(crop, save, workers=args.write_threads, max_pending=2 * args.write_threads)
+	i = 0
+	try:
+		for fb in pipeline.prefetch(read_frames(vfile, args.batch_size), depth=2):
+			preds = fa.get_detections_for_batch(np.asarray(fb))
+			workers.submit(fb, preds, i)
+			i += len(fb)
+		workers.close()
+		if writer is not None:
+			writer.close(mel=audio.load_mel(wavpath.result()))
+	except:
+		# stop the crop / save threads before aborting the writer they add to (a no-op once closed)
+		workers.abort()
+		if writer is not None:
+			writer.abort()
+		raise
 
-def process_audio_file(vfile, args):
-	vidname = os.path.basename(vfile).split('.')[0]
-	dirname = vfile.split('/')[-2]
+	return i, num_faces[0]
 
-	fulldir = path.join(args.preprocessed_root, dirname, vidname)
-	os.makedirs(fulldir, exist_ok=True)
+def process_audio_file(vfile, args):
+	wavpath = path.join(output_dir(vfile, args), 'audio.wav')
 
-	wavpath = path.join(fulldir, 'audio.wav')
+	command = [part.format(vfile=vfile, wavpath=wavpath) for part in template]
+	if subprocess.call(command) != 0:
+		raise RuntimeError('ffmpeg failed to extract the audio of {}'.format(vfile))
 
-	command = template.format(vfile, wavpath)
-	subprocess.call(command, shell=True)
+	# memory-mapped by the training datasets instead of recomputing the mel for every sample
+	audio.save_mel(wavpath)
+	return wavpath
 
-	
 def mp_handler(job):
-	vfile, args, gpu_id = job
+	vfile, args = job
+	start = time.time()
+	record = {'video': vfile, 'format': args.format}
 	try:
-		process_video_file(vfile, args, gpu_id)
+		# ffmpeg extracts the audio while the video is decoded and detected
+		with ThreadPoolExecutor(1) as audio_pool:
+			wavpath = audio_pool.submit(process_audio_file, vfile, args)
+			record['frames'], record['faces'] = process_video_file(vfile, args, wavpath)
+			wavpath.result()
+		record['status'] = 'ok'
 	except KeyboardInterrupt:
-		exit(0)
+		raise
 	except:
 		traceback.print_exc()
-		
+		record['status'] = 'error'
+		record['error'] = traceback.format_exc().strip().split('\n')[-1]
+	record['seconds'] = round(time.time() - start, 3)
+	return record
+
+def read_manifest(manifest):
+	done = set()
+	if not path.isfile(manifest):
+		return done
+
+	with open(manifest) as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue # a line cut short by a crash
+			if record.get('status') == 'ok':
+				done.add((record['video'], record['format']))
+	return done
+
 def main(args):
-	print('Started processing for {} with {} GPUs'.format(args.data_root, args.ngpu))
+	ngpu = min(args.ngpu, torch.cuda.device_count())
+	if ngpu > 0:
+		devices = ['cuda:{}'.format(id) for id in range(ngpu)] * args.workers_per_gpu
+	else:
+		print('No GPU available, detecting faces on the CPU')
+		devices = ['cpu'] * args.workers_per_gpu
+	print('Started processing for {} with {} workers'.format(args.data_root, len(devices)))
+
+	manifest = args.manifest or path.join(args.preprocessed_root, 'manifest.jsonl')
+	os.makedirs(path.dirname(path.abspath(manifest)), exist_ok=True)
+	done = read_manifest(manifest)
 
 	filelist = glob(path.join(args.data_root, '*/*.mp4'))
-
-	jobs = [(vfile, args, i%args.ngpu) for i, vfile in enumerate(filelist)]
-	p = ThreadPoolExecutor(args.ngpu)
-	futures = [p.submit(mp_handler, j) for j in jobs]
-	_ = [r.result() for r in tqdm(as_completed(futures), total=len(futures))]
-
-	print('Dumping audios...')
-
-	for vfile in tqdm(filelist):
-		try:
-			process_audio_file(vfile, args)
-		except KeyboardInterrupt:
-			exit(0)
-		except:
-			traceback.print_exc()
-			continue
+	jobs = [(vfile, args) for vfile in filelist if (vfile, args.format) not in done]
+	if len(jobs) < len(filelist):
+		print('Skipping {} videos already processed according to {}'.format(len(filelist) - len(jobs), manifest))
+
+	# spawn, so that no worker inherits a CUDA context
+	ctx = mp.get_context('spawn')
+	device_queue = ctx.Queue()
+	for device in devices:
+		device_queue.put(device)
+
+	failed = 0
+	with ctx.Pool(len(devices), initializer=init_worker, initargs=(device_queue, args.nms_top_k)) as p, open(manifest, 'a') as f:
+		for record in tqdm(p.imap_unordered(mp_handler, jobs), total=len(jobs)):
+			f.write(json.dumps(record) + '\n')
+			f.flush()
+			failed += record['status'] != 'ok'
+
+	if failed > 0:
+		print('{} videos failed, rerun to retry them'.format(failed))
 
 if __name__ == '__main__':
-	main(args)
\ No newline at end of file
+	main(parser.parse_args())
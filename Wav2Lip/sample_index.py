@@ -0,0 +1,122 @@
+"""Precomputed index of the training samples of a list of preprocessed videos.
+
+A sample is a (video, start frame) whose syncnet_T frame window exists and whose
+mel crops all fall inside the clip's mel. Building the index reads every video's
+frame ids and mel length once; the result is saved next to the data, keyed by the
+video list and the sampling parameters, and loaded on later runs. Delete the
+samples_*.npz files after re-preprocessing videos in place.
+"""
+import os, json, hashlib
+from os.path import join, basename
+from glob import glob
+import random
+import numpy as np
+from tqdm import tqdm
+
+import audio
+import shards
+
+def video_frames(vidname):
+    """(sorted frame ids, number of mel frames) of a preprocessed video, from its shard or jpg folder."""
+    shard = shards.open_shard(vidname)
+    if shard is not None:
+        frame_ids = shard.frame_ids
+        mel = shard.mel if shard.mel is not None else audio.load_mel(join(vidname, 'audio.wav'))
+    else:
+        frame_ids = np.array(sorted(int(basename(f).split('.')[0]) for f in glob(join(vidname, '*.jpg'))), dtype=np.int64)
+        mel = audio.load_mel(join(vidname, 'audio.wav'))
+    return frame_ids, mel.shape[0]
+
+def window_starts(frame_ids, T):
+    # starts s whose frames s .. s + T - 1 all exist; frame_ids are sorted and unique
+    if len(frame_ids) < T:
+        return frame_ids[:0]
+    return frame_ids[:len(frame_ids) - T + 1][frame_ids[T - 1:] - frame_ids[:len(frame_ids) - T + 1] == T - 1]
+
+class SampleIndex(object):
+    """Maps a sample index to (video, start frame, wrong start frame).
+
+    mel_offsets: (lo, hi) range of frames, relative to the start frame, whose
+    mel_step_size mel crop a sample needs, e.g. (-1, 3) for the Wav2Lip datasets
+    whose segmented mels cover frames start - 1 .. start + 3.
+
+    shard_id / num_shards keep every num_shards-th sample, so each node of a multi
+    node run trains on a disjoint part. Within a node, the DataLoader sampler already
+    hands each worker different indices.
+    """
+
+    version = 1
+
+    def __init__(self, videos, cache_dir=None, T=5, mel_offsets=(0, 0), mel_step_size=16, fps=25,
+                 min_frames=None, shard_id=0, num_shards=1):
+        self.videos = videos
+        self.T = T
+        self.mel_offsets = mel_offsets
+        self.mel_step_size = mel_step_size
+        self.fps = fps
+        self.min_frames = 3 * T if min_frames is None else min_frames
+
+        params = dict(version=self.version, T=T, mel_offsets=list(mel_offsets), mel_step_size=mel_step_size,
+                      fps=fps, min_frames=self.min_frames,
+                      videos=hashlib.sha1('\n'.join(videos).encode('utf-8')).hexdigest())
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+            path = join(cache_dir, 'samples_{}.npz'.format(key[:16]))
+
+        if path is not None and os.path.isfile(path):
+            with np.load(path) as index:
+                self.samples, self.starts, self.offsets = index['samples'], index['starts'], index['offsets']
+        else:
+            self.build()
+            if path is not None:
+                self.save(path)
+
+        self.samples = self.samples[shard_id::num_shards]
+
+    def _mel_frame(self, frame):
+        return int(80. * (frame / float(self.fps)))
+
+    def build(self):
+        samples, starts, offsets = [], [], [0]
+        lo, hi = self.mel_offsets
+        for v, vidname in enumerate(tqdm(self.videos, desc='Indexing samples')):
+            try:
+                frame_ids, num_mel_frames = video_frames(vidname)
+            except Exception:
+                frame_ids, num_mel_frames = np.zeros(0, dtype=np.int64), 0
+
+            video_starts = window_starts(frame_ids, self.T)
+            # a wrong window needs another start of the same video
+            if len(frame_ids) <= self.min_frames or len(video_starts) < 2:
+                video_starts = video_starts[:0]
+            starts.append(video_starts)
+            offsets.append(offsets[-1] + len(video_starts))
+
+            valid = [s for s in video_starts.tolist() if s + lo >= 0 and
+                     self._mel_frame(s + hi) + self.mel_step_size <= num_mel_frames]
+            samples.extend((v, s) for s in valid)
+
+        self.samples = np.array(samples, dtype=np.int64).reshape(-1, 2)
+        self.starts = np.concatenate(starts).astype(np.int64) if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def save(self, path):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, samples=self.samples, starts=self.starts, offsets=self.offsets)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass # read-only data root, the index is rebuilt next time
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        v, start = self.samples[idx]
+        video_starts = self.starts[self.offsets[v] : self.offsets[v + 1]]
+        wrong_start = start
+        while wrong_start == start:
+            wrong_start = video_starts[random.randint(0, len(video_starts) - 1)]
+        return self.videos[v], int(start), int(wrong_start)
@@ -0,0 +1,109 @@
+"""Single-file container for a preprocessed video.
+
+A shard replaces a directory of `{frame_id}.jpg` face crops: the crops are stored
+pre-resized as one (N, img_size, img_size, 3) uint8 array, followed by their frame
+ids and, optionally, the (T, num_mels) float32 mel of the clip. Arrays are memory
+mapped on read, so a training sample touches one already open file instead of a
+glob, an isfile and an imread per frame.
+
+Layout: the raw arrays back to back, then a JSON footer describing them (offset,
+shape, dtype), then the footer length as a little-endian uint64 and a magic tag.
+"""
+import os, json, struct
+from functools import lru_cache
+import numpy as np
+import cv2
+
+MAGIC = b'W2LSHRD1'
+VERSION = 1
+
+def shard_path(vidname):
+    # shard of a preprocessed video directory, e.g. preprocessed_root/dirname/vidname.shard
+    return vidname.rstrip('/\\') + '.shard'
+
+class ShardWriter(object):
+    """Appends face crops one at a time; close() adds the index and mel and publishes the file."""
+
+    def __init__(self, path, img_size=96):
+        self.path = path
+        self.img_size = img_size
+        self.tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self.file = open(self.tmp_path, 'wb')
+        self.frame_ids = []
+
+    def add(self, frame_id, face):
+        if len(self.frame_ids) > 0 and frame_id <= self.frame_ids[-1]:
+            raise ValueError('Frame ids must be increasing, got {} after {}'.format(frame_id, self.frame_ids[-1]))
+        face = cv2.resize(face, (self.img_size, self.img_size))
+        self.file.write(np.ascontiguousarray(face, dtype=np.uint8).tobytes())
+        self.frame_ids.append(frame_id)
+
+    def _write_array(self, array):
+        entry = {'offset': self.file.tell(), 'shape': list(array.shape), 'dtype': array.dtype.str}
+        self.file.write(np.ascontiguousarray(array).tobytes())
+        return entry
+
+    def close(self, mel=None):
+        footer = {'version': VERSION,
+                    'frames': {'offset': 0, 'shape': [len(self.frame_ids), self.img_size, self.img_size, 3],
+                                'dtype': np.dtype(np.uint8).str},
+                    'frame_ids': self._write_array(np.asarray(self.frame_ids, dtype=np.int32))}
+        if mel is not None:
+            footer['mel'] = self._write_array(np.asarray(mel, dtype=np.float32))
+
+        footer = json.dumps(footer).encode('utf-8')
+        self.file.write(footer)
+        self.file.write(struct.pack('<Q', len(footer)) + MAGIC)
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+class Shard(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            f.seek(-16, os.SEEK_END)
+            footer_size, magic = struct.unpack('<Q8s', f.read(16))
+            if magic != MAGIC:
+                raise ValueError('{} is not a shard file'.format(path))
+            f.seek(-16 - footer_size, os.SEEK_END)
+            footer = json.loads(f.read(footer_size).decode('utf-8'))
+
+        self.frames = self._map(footer['frames'])
+        self.frame_ids = np.array(self._map(footer['frame_ids']))
+        self.mel = self._map(footer['mel']) if 'mel' in footer else None
+
+    def _map(self, entry):
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            return np.zeros(shape, dtype=entry['dtype'])
+        # copy-on-write, so slices can be handed to torch like any writable array
+        return np.memmap(self.path, dtype=entry['dtype'], mode='c', offset=entry['offset'], shape=shape)
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def window(self, start_id, T):
+        """Frames (T, H, W, 3) of ids start_id .. start_id + T - 1, or None if any of them is missing."""
+        row = np.searchsorted(self.frame_ids, start_id)
+        if row + T > len(self.frame_ids) or self.frame_ids[row] != start_id \
+                or self.frame_ids[row + T - 1] != start_id + T - 1:
+            return None
+        return self.frames[row : row + T]
+
+@lru_cache(maxsize=64)
+def _open_shard(path):
+    return Shard(path)
+
+def open_shard(vidname):
+    """The shard of a preprocessed video directory, or None if it was preprocessed as JPEGs.
+
+    Open shards are cached per process, so each DataLoader worker maps a file once.
+    """
+    try:
+        return _open_shard(shard_path(vidname))
+    except FileNotFoundError:
+        return None
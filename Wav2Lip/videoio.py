@@ -0,0 +1,89 @@
+import os, subprocess
+import numpy as np
+import cv2
+
+def read_frames(path, resize_factor=1, rotate=False, crop=(0, -1, 0, -1), limit=None):
+	"""Yields the frames of a video one at a time, after the optional downscale,
+	90deg rotation and (top, bottom, left, right) crop. Stops after `limit` frames."""
+	video_stream = cv2.VideoCapture(path)
+	try:
+		count = 0
+		while limit is None or count < limit:
+			still_reading, frame = video_stream.read()
+			if not still_reading:
+				break
+			if resize_factor > 1:
+				frame = cv2.resize(frame, (frame.shape[1]//resize_factor, frame.shape[0]//resize_factor))
+
+			if rotate:
+				frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+			y1, y2, x1, x2 = crop
+			if x2 == -1: x2 = frame.shape[1]
+			if y2 == -1: y2 = frame.shape[0]
+
+			yield frame[y1:y2, x1:x2]
+			count += 1
+	finally:
+		video_stream.release()
+
+class FFmpegWriter(object):
+	"""Encodes raw BGR frames piped over stdin with a single ffmpeg process.
+
+	When `audio` is given it is muxed in the same pass, so the rendered frames
+	are encoded exactly once and no intermediate video file is written.
+	"""
+
+	def __init__(self, outfile, fps, frame_size, audio=None, codec='libx264', preset='medium', crf=18,
+					ffmpeg_path='ffmpeg'):
+		frame_w, frame_h = frame_size
+		self.frame_bytes = frame_w * frame_h * 3
+
+		command = [ffmpeg_path, '-y', '-loglevel', 'error',
+					'-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(frame_w, frame_h),
+					'-r', str(fps), '-i', '-']
+		if audio is not None:
+			command += ['-i', audio, '-map', '0:v:0', '-map', '1:a:0']
+
+		command += ['-c:v', codec]
+		if preset:
+			command += ['-preset', preset]
+		if crf is not None:
+			command += ['-crf', str(crf)]
+		# yuv420p needs even dimensions, face crops of odd-sized videos would otherwise fail to encode
+		command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p']
+
+		if audio is not None:
+			command += ['-c:a', 'aac', '-shortest']
+		command.append(outfile)
+
+		self.outfile = outfile
+		self.proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+	def write(self, frame):
+		frame = np.ascontiguousarray(frame, dtype=np.uint8)
+		if frame.nbytes != self.frame_bytes:
+			raise ValueError('Frame of shape {} does not match the writer frame size'.format(frame.shape))
+		try:
+			self.proc.stdin.write(frame.data)
+		except BrokenPipeError:
+			raise RuntimeError('ffmpeg exited with code {} while writing {}'.format(self.proc.wait(), self.outfile))
+
+	def close(self):
+		if self.proc.stdin.closed:
+			return
+		self.proc.stdin.close()
+		returncode = self.proc.wait()
+		if returncode != 0:
+			raise RuntimeError('ffmpeg exited with code {} while writing {}'.format(returncode, self.outfile))
+
+	def abort(self):
+		"""Kills ffmpeg and removes the partial outfile, e.g. when rendering failed."""
+		self.proc.kill()
+		try:
+			self.proc.stdin.close()
+		except OSError:
+			pass
+		self.proc.wait()
+		if os.path.exists(self.outfile):
+			os.remove(self.outfile)
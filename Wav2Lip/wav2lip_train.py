@@ -4,6 +4,9 @@ from tqdm import tqdm
 from models import SyncNet_color as SyncNet
 from models import Wav2Lip as Wav2Lip
 import audio
+import shards
+from sample_index import SampleIndex
+from checkpoints import CheckpointWriter
 
 import torch
 from torch import nn
@@ -25,6 +28,8 @@ parser.add_argument('--checkpoint_dir', help='Save checkpoints to this directory
 parser.add_argument('--syncnet_checkpoint_path', help='Load the pre-trained Expert discriminator', required=True, type=str)
 
 parser.add_argument('--checkpoint_path', help='Resume from this checkpoint', default=None, type=str)
+parser.add_argument('--shard_id', help='Train on the shard_id-th of num_shards disjoint parts of the training samples (multi node runs)', default=0, type=int)
+parser.add_argument('--num_shards', help='Number of training sample shards', default=1, type=int)
 
 args = parser.parse_args()
 
@@ -33,6 +38,7 @@ global_step = 0
 global_epoch = 0
 use_cuda = torch.cuda.is_available()
 print('use_cuda: {}'.format(use_cuda))
+checkpoint_writer = CheckpointWriter(keep_last=hparams.keep_checkpoints)
 
 syncnet_T = 5
 syncnet_mel_step_size = 16
@@ -40,8 +46,14 @@ syncnet_mel_step_size = 16
 class Dataset(object):
     def __init__(self, split):
         self.all_videos = get_image_list(args.data_root, split)
+        shard_id, num_shards = (args.shard_id, args.num_shards) if split == 'train' else (0, 1)
+        self.samples = SampleIndex(self.all_videos, args.data_root, syncnet_T, mel_offsets=(-1, 3),
+                                   mel_step_size=syncnet_mel_step_size, fps=hparams.fps,
+                                   shard_id=shard_id, num_shards=num_shards)
 
     def get_frame_id(self, frame):
+        if type(frame) == int:
+            return frame # shard frame ids are ints already
         return int(basename(frame).split('.')[0])
 
     def get_window(self, start_frame):
@@ -72,6 +84,11 @@ class Dataset(object):
 
         return window
 
+    def load_window(self, vidname, shard, start_id):
+        if shard is not None:
+            return shard.window(start_id, syncnet_T)
+        return self.read_window(self.get_window(join(vidname, '{}.jpg'.format(start_id))))
+
     def crop_audio_window(self, spec, start_frame):
         if type(start_frame) == int:
             start_frame_num = start_frame
@@ -106,48 +123,37 @@ class Dataset(object):
         return x
 
     def __len__(self):
-        return len(self.all_videos)
+        return len(self.samples)
 
     def __getitem__(self, idx):
         while 1:
-            idx = random.randint(0, len(self.all_videos) - 1)
-            vidname = self.all_videos[idx]
-            img_names = list(glob(join(vidname, '*.jpg')))
-            if len(img_names) <= 3 * syncnet_T:
-                continue
-            
-            img_name = random.choice(img_names)
-            wrong_img_name = random.choice(img_names)
-            while wrong_img_name == img_name:
-                wrong_img_name = random.choice(img_names)
-
-            window_fnames = self.get_window(img_name)
-            wrong_window_fnames = self.get_window(wrong_img_name)
-            if window_fnames is None or wrong_window_fnames is None:
-                continue
+            vidname, img_name, wrong_img_name = self.samples[idx]
+            # indexed samples are valid; this is only used if the files changed since indexing
+            idx = random.randint(0, len(self.samples) - 1)
+            shard = shards.open_shard(vidname)
 
-            window = self.read_window(window_fnames)
+            window = self.load_window(vidname, shard, img_name)
             if window is None:
                 continue
 
-            wrong_window = self.read_window(wrong_window_fnames)
+            wrong_window = self.load_window(vidname, shard, wrong_img_name)
             if wrong_window is None:
                 continue
 
             try:
-                wavpath = join(vidname, "audio.wav")
-                wav = audio.load_wav(wavpath, hparams.sample_rate)
-
-                orig_mel = audio.melspectrogram(wav).T
+                if shard is not None and shard.mel is not None:
+                    orig_mel = shard.mel
+                else:
+                    orig_mel = audio.load_mel(join(vidname, "audio.wav"))
             except Exception as e:
                 continue
 
-            mel = self.crop_audio_window(orig_mel.copy(), img_name)
+            mel = self.crop_audio_window(orig_mel, img_name)
             
             if (mel.shape[0] != syncnet_mel_step_size):
                 continue
 
-            indiv_mels = self.get_segmented_mels(orig_mel.copy(), img_name)
+            indiv_mels = self.get_segmented_mels(orig_mel, img_name)
             if indiv_mels is None: continue
 
             window = self.prepare_window(window)
@@ -296,13 +302,12 @@ def save_checkpoint(model, optimizer, step, checkpoint_dir, epoch):
     checkpoint_path = join(
         checkpoint_dir, "checkpoint_step{:09d}.pth".format(global_step))
     optimizer_state = optimizer.state_dict() if hparams.save_optimizer_state else None
-    torch.save({
+    checkpoint_writer.save(checkpoint_path, {
         "state_dict": model.state_dict(),
         "optimizer": optimizer_state,
         "global_step": step,
         "global_epoch": epoch,
-    }, checkpoint_path)
-    print("Saved checkpoint:", checkpoint_path)
+    }, prefix='checkpoint_step')
 
 
 def _load(checkpoint_path):
@@ -346,8 +351,9 @@ if __name__ == "__main__":
         train_dataset, batch_size=hparams.batch_size, shuffle=True,
         num_workers=hparams.num_workers)
 
+    # eval_model stops after eval_steps batches, shuffle so they cover all the val videos
     test_data_loader = data_utils.DataLoader(
-        test_dataset, batch_size=hparams.batch_size,
+        test_dataset, batch_size=hparams.batch_size, shuffle=True,
         num_workers=4)
 
     device = torch.device("cuda" if use_cuda else "cpu")
@@ -368,7 +374,17 @@ if __name__ == "__main__":
         os.mkdir(checkpoint_dir)
 
     # Train!
-    train(device, model, train_data_loader, test_data_loader, optimizer,
-              checkpoint_dir=checkpoint_dir,
-              checkpoint_interval=hparams.checkpoint_interval,
-              nepochs=hparams.nepochs)
+    try:
+        train(device, model, train_data_loader, test_data_loader, optimizer,
+                  checkpoint_dir=checkpoint_dir,
+                  checkpoint_interval=hparams.checkpoint_interval,
+                  nepochs=hparams.nepochs)
+    except:
+        # also on ctrl+c, so that queued checkpoints are not lost; a failed save must not
+        # hide the exception that stopped training
+        try:
+            checkpoint_writer.flush()
+        except Exception as e:
+            print('Could not save the queued checkpoints: {}'.format(e))
+        raise
+    checkpoint_writer.flush()
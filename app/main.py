@@ -1,8 +1,7 @@
 # app/main.py
 import os
-import subprocess
 import urllib.request
-from modules import pdf_utils, story_engine, tts, video_gen
+from modules import pdf_utils, story_engine, tts, video_gen, lipsync
 import torch
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Device set to use {device}")
@@ -42,15 +41,9 @@ def run_pipeline(pdf_path: str, out_path: str):
         raise FileNotFoundError("Missing assets/face.jpg. Please place a portrait image in assets/face.jpg")
 
 
-    # Run Wav2Lip inference
+    # Run Wav2Lip inference (on the warm lip-sync server when one is running)
     print(f"Generating video for audio file: {audio_path}")
-    subprocess.run([
-    "python", "Wav2Lip/inference.py",
-    "--checkpoint_path", checkpoints_path,
-    "--face", face_path,
-    "--audio", audio_path,
-    "--outfile", output_path
-    ], check=True)
+    lipsync.apply(face_path, audio_path, output_path, checkpoint_path=checkpoints_path)
 
 
     print(f"✅ Done! Video saved at {output_path}")
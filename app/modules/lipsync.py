@@ -1,8 +1,74 @@
 # modules/lipsync.py
-def apply(video_path, audio_path, out_path):
+import json
+import os
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+# Address of a running `Wav2Lip/lipsync_server.py`; jobs fall back to a one-off
+# `inference.py` subprocess when nothing is listening there.
+SERVER_URL = os.environ.get("WAV2LIP_SERVER", "http://127.0.0.1:8765")
+INFERENCE_SCRIPT = os.path.join("Wav2Lip", "inference.py")
+
+
+# The server is local, so requests bypass any http_proxy from the environment
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+# Gateway errors come from something between us and the server (e.g. a proxy), the server itself
+# only answers 400/404/500; they mean no server is reachable, like a refused connection
+_UNREACHABLE_CODES = (502, 503, 504)
+
+
+class ServerUnavailable(Exception):
+    pass
+
+
+def _submit(face_path, audio_path, out_path, options):
+    job = {"face": face_path, "audio": audio_path, "outfile": out_path, "options": options}
+    request = urllib.request.Request(SERVER_URL + "/jobs", data=json.dumps(job).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with _opener.open(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code in _UNREACHABLE_CODES:
+            raise ServerUnavailable(f"Lip-sync server unreachable: HTTP {e.code}")
+        raise RuntimeError(f"Lip-sync server rejected job: {e.read().decode('utf-8', 'replace')}")
+    except urllib.error.URLError as e:
+        raise ServerUnavailable(f"Lip-sync server unreachable: {e.reason}")
+
+
+def apply(video_path, audio_path, out_path, checkpoint_path=os.path.join("checkpoints", "wav2lip.pth"),
+          **options):
     """
     Run Wav2Lip on the face region for better lip synchronization.
     If your generated faces are stylized, you can skip or apply lightly.
+
+    `video_path` may be a still image or a video. Extra keyword arguments are
+    passed on as `inference.py` options (e.g. pads=[0, 10, 0, 0]).
+    The warm lip-sync server is used when reachable; `checkpoint_path` only
+    applies to the subprocess fallback, the server uses the checkpoint it was started with.
     """
-    # call wav2lip inference script here
-    pass
+    video_path, audio_path, out_path = map(os.path.abspath, (video_path, audio_path, out_path))
+
+    try:
+        _submit(video_path, audio_path, out_path, options)
+        return out_path
+    except ServerUnavailable:
+        pass  # no server running
+
+    cmd = [sys.executable, INFERENCE_SCRIPT,
+           "--checkpoint_path", checkpoint_path,
+           "--face", video_path,
+           "--audio", audio_path,
+           "--outfile", out_path]
+    for key, value in options.items():
+        if value is False:
+            continue
+        cmd.append(f"--{key}")
+        if value is not True:
+            cmd.extend(str(v) for v in (value if isinstance(value, (list, tuple)) else [value]))
+
+    subprocess.run(cmd, check=True)
+    return out_path
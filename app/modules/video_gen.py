@@ -3,6 +3,8 @@ import os
 import subprocess
 import logging
 
+from modules import lipsync
+
 # Configure logging for better error reporting
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -19,28 +21,20 @@ def generate_video(audio_file: str, scenes: list, output_file: str):
     gen_file = os.path.join(wav2lip_output_dir, "result_voice.mp4")
 
     # Generate talking head with Wav2Lip
-    cmd = [
-        "python", "inference.py",
-        "--checkpoint_path", "checkpoints/wav2lip.pth",
-        "--face", "avatar.png",
-        "--audio", os.path.abspath(audio_file),
-        "--outfile", gen_file
-    ]
-
     try:
-        logging.info("Running Wav2Lip subprocess...")
-        # Run the subprocess with error checking
-        result = subprocess.run(cmd, cwd="Wav2Lip", check=True, capture_output=True, text=True)
-        logging.info("Wav2Lip stdout:\n" + result.stdout)
-        logging.info("Wav2Lip stderr:\n" + result.stderr)
+        logging.info("Running Wav2Lip lip-sync job...")
+        lipsync.apply(os.path.join("Wav2Lip", "avatar.png"), audio_file, gen_file,
+                      checkpoint_path=os.path.join("Wav2Lip", "checkpoints", "wav2lip.pth"))
         logging.info("Wav2Lip process completed successfully.")
 
     except subprocess.CalledProcessError as e:
         logging.error(f"Wav2Lip subprocess failed with exit code {e.returncode}")
-        logging.error(f"stdout: {e.stdout}")
-        logging.error(f"stderr: {e.stderr}")
         return None  # Return None to signal failure
 
+    except RuntimeError as e:
+        logging.error(f"Wav2Lip lip-sync job failed: {e}")
+        return None
+
     # Check if the generated file exists before moving it
     if os.path.exists(gen_file):
         logging.info(f"Wav2Lip output file found: {gen_file}")